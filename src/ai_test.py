@@ -1,15 +1,31 @@
+import os
+import re
 import unittest
 import json
-import requests
+import sys
+import tempfile
+from types import SimpleNamespace
+from sqlalchemy import create_engine, event, text
+
+# Each test gets a fresh in-memory database, which has to be configured before
+# the app is imported. Never the real one, since every test wipes it.
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL", "sqlite://")
+
 from app import app
-from threading import Thread
-from time import sleep
+from db import db, set_sqlite_pragmas, Battle, Character, Weapon, Log, WEAPON_CATALOG, weapon_cache
+from db import LOG_START, LOG_ROUND, LOG_WIN, LOG_CUSTOM
+import config
+import dao
+import metrics
+import serializer
+import combat
+import simulate
+import seed
+import upgrade
+import numpy as np
 from copy import copy
 from functools import reduce
 
-# URL pointing to your local dev host
-LOCAL_URL = "http://localhost:5000"
-
 # Constants
 MHP = 10
 ATK = 2
@@ -26,12 +42,14 @@ SAMPLE_CHARACTER_PREPARE = lambda wid: {"weapon_id": wid}
 SAMPLE_WEAPON = {"name": "Rubber Duck", "atk": 1337}
 SAMPLE_BATTLE = lambda chal_id, o_id=None: {"challenger_id": chal_id, "opponent_id": o_id}
 SAMPLE_BATTLE_ACTION = lambda actor_id, action: {"actor_id": actor_id, "action": action}
+SAMPLE_AUTO_BATTLE = lambda actor_id, strategy: {"actor_id": actor_id, "strategy": strategy}
 SAMPLE_LOG = {"timestamp": 1234, "challenger_hp": 20, "opponent_hp": 20, "action": "COVID Outbreak"}
 SAMPLE_REQUEST = lambda kind, s_id, r_id: {"kind": kind, "sender_id": s_id, "receiver_id": r_id}
 SAMPLE_RESPONSE = lambda r_id, accepted: {"receiver_id": r_id, "accepted": accepted}
 
 # API Documentation error messages
 USER_BAD_REQUEST = "Provide a proper request of the form {username: string}"
+USER_PAGE_BAD_REQUEST = "Provide a proper query of the form ?after=number&limit=1..1000"
 USER_NOT_FOUND = "This user does not exist!"
 
 USER_END_FRIENDSHIP_BAD_REQUEST = "Provide a proper request of the form {ex_friend_id: number}"
@@ -67,6 +85,14 @@ BATTLE_ACTION_DONE_FORBIDDEN = "The provided battle is already done!"
 BATTLE_ACTION_ALREADY_FORBIDDEN = "This character has already sent an action!"
 BATTLE_ACTION_BATTLE_NOT_FOUND = "The provided battle does not exist!"
 
+BATCH_ACTIONS_BAD_REQUEST = "Provide a proper request of the form {actions: [{bid: number, \
+actor_id: number, action: string}]} with 1..500 actions"
+BATCH_ACTIONS_BAD_ITEM = "Provide a proper action of the form {bid: number, actor_id: number, action: string}"
+
+AUTO_BATTLE_BAD_REQUEST = "Provide a proper request of the form {actor_id: number, strategy: string}"
+AUTO_BATTLE_BAD_REQUEST_STRATEGY = "Field strategy must be Attack, Defend, Counter, or random"
+AUTO_BATTLE_PVP_FORBIDDEN = "Only battles against the AI can be auto-battled!"
+
 LOG_STARTING_ACTION = lambda chal_name, o_name: (
     f"The battle between Challenger {chal_name} and Opponent {o_name} has begun."
 )
@@ -108,88 +134,156 @@ REQUEST_RESPOND_FORBIDDEN_ANOTHERS = "This request was not sent to you!"
 REQUEST_RESPOND_FORBIDDEN_ACCEPTED = "This request has already been accepted!"
 REQUEST_RESPOND_FORBIDDEN_DENIED = "This request has already been denied!"
 
+# Stands in for the requests library, answering from app.test_client() in this process
+class ApiClient:
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def open(self, method, url, params=None, stream=False, **kwargs):
+        query = {name: value for name, value in (params or {}).items() if value is not None}
+        response = self.client.open(url, method=method, query_string=query, buffered=not stream, **kwargs)
+        return ClientResponse(response, method, url)
+
+    def get(self, url, **kwargs):
+        return self.open("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.open("POST", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.open("DELETE", url, **kwargs)
+
+class ClientResponse:
+
+    def __init__(self, response, method, url):
+        self.response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.request = SimpleNamespace(method=method, url=url)
+
+    @property
+    def text(self):
+        return self.response.get_data(as_text=True)
+
+    def json(self):
+        return json.loads(self.response.get_data())
+
+    def iter_lines(self):
+        # Only pulls as much of a streamed body as the caller reads, and hangs
+        # up once it stops, as a real client's disconnect would
+        pending = ""
+        try:
+            for chunk in self.response.iter_encoded():
+                *lines, pending = (pending + chunk.decode()).split("\n")
+                yield from lines
+        finally:
+            self.response.close()
+
+client = ApiClient(app)
+
+def reset_database():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        weapon_cache.invalidate()
+
+class DatabaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        reset_database()
+
 # Request endpoint generators
 def gen_users_path(user_id=None):
-    base_path = f"{LOCAL_URL}/api/users"
+    base_path = "/api/users"
     return base_path + "/" if user_id is None else f"{base_path}/{str(user_id)}/"
 
 def gen_characters_path(user_id, character_id=None):
-    base_path = f"{LOCAL_URL}/api/users/{str(user_id)}/characters"
+    base_path = f"/api/users/{str(user_id)}/characters"
     return base_path + "/" if character_id is None else f"{base_path}/{str(character_id)}/"
 
 def gen_weapons_path(weapon_id=None):
-    base_path = f"{LOCAL_URL}/api/weapons"
+    base_path = "/api/weapons"
     return base_path + "/" if weapon_id is None else f"{base_path}/{str(weapon_id)}/"
 
 def gen_battles_path(battle_id=None):
-    base_path = f"{LOCAL_URL}/api/battles"
+    base_path = "/api/battles"
     return base_path + "/" if battle_id is None else f"{base_path}/{str(battle_id)}/"
 
 def gen_logs_path(battle_id, log_id=None):
-    base_path = f"{LOCAL_URL}/api/battles/{str(battle_id)}/logs"
+    base_path = f"/api/battles/{str(battle_id)}/logs"
     return base_path + "/" if log_id is None else f"{base_path}/{str(log_id)}/"
 
 def gen_requests_path(request_id=None):
-    base_path = f"{LOCAL_URL}/api/requests"
+    base_path = "/api/requests"
     return base_path + "/" if request_id is None else f"{base_path}/{str(request_id)}/"
 
 # Request helpers
 def get_user(user_id=None, code=200):
     if user_id:
-        res = requests.get(gen_users_path(user_id))
+        res = client.get(gen_users_path(user_id))
     else:
-        res = requests.get(gen_users_path())
+        res = client.get(gen_users_path())
     return unwrap_response(res, code)
 
+def get_user_page(after=None, limit=None, stream=False, code=200):
+    params = {"after": after, "limit": limit, "stream": "true" if stream else None}
+    res = client.get(gen_users_path(), params=params)
+    if stream and code == 200:
+        assert res.status_code == code
+        assert res.headers["Content-Type"] == "application/x-ndjson"
+        return [json.loads(line) for line in res.text.splitlines()]
+    return unwrap_response(res, code, params)
+
 def create_user(data=None, sample_type=1, code=201):
     sample_data = SAMPLE_USER_ONE if sample_type == 1 else SAMPLE_USER_TWO
-    res = requests.post(gen_users_path(), 
+    res = client.post(gen_users_path(), 
                         data=json.dumps(sample_data if data is None else data))
     return unwrap_response(res, code, data)
 
 def delete_user(user_id, code=202):
-    res = requests.delete(gen_users_path(user_id))
+    res = client.delete(gen_users_path(user_id))
     return unwrap_response(res, code)
 
 def end_friendship(user_id, data, code=200):
-    res = requests.post(gen_users_path(user_id), data=json.dumps(data))
+    res = client.post(gen_users_path(user_id), data=json.dumps(data))
     return unwrap_response(res, code)
 
 def create_character(user_id, data=None, sample_type=1, code=201):
     sample_data = SAMPLE_CHARACTER_ONE if sample_type == 1 else SAMPLE_CHARACTER_TWO
-    res = requests.post(gen_characters_path(user_id), 
+    res = client.post(gen_characters_path(user_id), 
                         data=json.dumps(sample_data if data is None else data))
     return unwrap_response(res, code, data)
 
 def get_character(user_id, character_id, code=200):
-    res = requests.get(gen_characters_path(user_id, character_id))
+    res = client.get(gen_characters_path(user_id, character_id))
     return unwrap_response(res, code)
 
 def delete_character(user_id, character_id, code=202):
-    res = requests.delete(gen_characters_path(user_id, character_id))
+    res = client.delete(gen_characters_path(user_id, character_id))
     return unwrap_response(res, code)
 
 def prepare_weapon(user_id, character_id, data, code=200):
-    res = requests.post(gen_characters_path(user_id, character_id), data=json.dumps(data))
+    res = client.post(gen_characters_path(user_id, character_id), data=json.dumps(data))
     return unwrap_response(res, code, data)
 
 def get_weapon(weapon_id=None, code=200):
     if weapon_id:
-        res = requests.get(gen_weapons_path(weapon_id))
+        res = client.get(gen_weapons_path(weapon_id))
     else:
-        res = requests.get(gen_weapons_path())
+        res = client.get(gen_weapons_path())
     return unwrap_response(res, code)
 
 def create_weapon(data=SAMPLE_WEAPON, code=201):
-    res = requests.post(gen_weapons_path(), data=json.dumps(data))
+    res = client.post(gen_weapons_path(), data=json.dumps(data))
     return unwrap_response(res, code, data)
 
 def delete_weapon(weapon_id, code=202):
-    res = requests.delete(gen_weapons_path(weapon_id))
+    res = client.delete(gen_weapons_path(weapon_id))
     return unwrap_response(res, code)
 
 def create_battle(data, code=201):
-    res = requests.post(gen_battles_path(), data=json.dumps(data))
+    res = client.post(gen_battles_path(), data=json.dumps(data))
     return unwrap_response(res, code, data)
 
 def create_pvp_battle(code=201):
@@ -207,17 +301,66 @@ def create_ai_battle(code=201):
     return create_battle(battle, code)
 
 def get_battle(battle_id, code=200):
-    res = requests.get(gen_battles_path(battle_id))
+    res = client.get(gen_battles_path(battle_id))
     return unwrap_response(res, code)
 
 def delete_battle(battle_id, code=202):
-    res = requests.delete(gen_battles_path(battle_id))
+    res = client.delete(gen_battles_path(battle_id))
     return unwrap_response(res, code)
 
 def send_battle_action(battle_id, data, code=202):
-    res = requests.post(gen_battles_path(battle_id), data=json.dumps(data))
+    res = client.post(gen_battles_path(battle_id), data=json.dumps(data))
     return unwrap_response(res, code, data)
 
+def send_battle_actions(data, code=200):
+    res = client.post(gen_battles_path() + "actions/", data=json.dumps(data))
+    return unwrap_response(res, code, data)
+
+def auto_battle(battle_id, data, code=200):
+    res = client.post(gen_battles_path(battle_id) + "auto/", data=json.dumps(data))
+    return unwrap_response(res, code, data)
+
+def get_analytics(path, params=None, code=200):
+    res = client.get("/api/analytics/" + path, params=params)
+    return unwrap_response(res, code)
+
+def get_etag(path):
+    res = client.get(path)
+    assert res.status_code == 200
+    return res.headers["ETag"]
+
+def conditional_get(path, etag, code=304):
+    res = client.get(path, headers={"If-None-Match": etag})
+    assert res.status_code == code
+    if code == 304:
+        assert res.text == ""
+        assert res.headers["ETag"] == etag
+    return res
+
+def get_metrics():
+    res = client.get("/api/_metrics")
+    assert res.status_code == 200
+    assert res.headers["Content-Type"].startswith("text/plain")
+    samples = [line.rsplit(" ", 1) for line in res.text.splitlines() if not line.startswith("#")]
+    return {sample: float(value) for sample, value in samples}
+
+def watch_battle(battle_id, after=None, code=200):
+    res = client.get(gen_battles_path(battle_id) + "events/", params={"after": after}, stream=True)
+    if code != 200:
+        return unwrap_response(res, code)
+    assert res.headers["Content-Type"].startswith("text/event-stream")
+    return read_events(res.iter_lines())
+
+def read_events(lines):
+    event = {}
+    for line in lines:
+        if line and not line.startswith(":"):
+            field, _, value = line.partition(": ")
+            event[field] = value
+        elif not line and event:
+            yield event["event"], json.loads(event["data"])
+            event = {}
+
 def execute_action(challenger_action, opponent_action):
     (chal_uid, chal_cid), (o_uid, o_cid), _, bid = respond_to_battle_request()
     chal_act = SAMPLE_BATTLE_ACTION(chal_cid, challenger_action)
@@ -247,19 +390,19 @@ def execute_action_to_completion(chal_act, o_act):
     return (chal_uid, chal_id), (o_uid, o_id), bid
 
 def create_log(battle_id, data=SAMPLE_LOG, code=201):
-    res = requests.post(gen_logs_path(battle_id), data=json.dumps(data))
+    res = client.post(gen_logs_path(battle_id), data=json.dumps(data))
     return unwrap_response(res, code, data)
 
 def get_log(battle_id, log_id, code=200):
-    res = requests.get(gen_logs_path(battle_id, log_id))
+    res = client.get(gen_logs_path(battle_id, log_id))
     return unwrap_response(res, code)
 
 def delete_log(battle_id, log_id, code=202):
-    res = requests.delete(gen_logs_path(battle_id, log_id))
+    res = client.delete(gen_logs_path(battle_id, log_id))
     return unwrap_response(res, code)
 
 def get_request(request_id=None, code=200):
-    res = requests.get(gen_requests_path(request_id))
+    res = client.get(gen_requests_path(request_id))
     return unwrap_response(res, code)
 
 def build_request(kind):
@@ -271,15 +414,15 @@ def build_request(kind):
     return SAMPLE_REQUEST(kind, sender["id"], receiver["id"])
 
 def create_request(data, code=201):
-    res = requests.post(gen_requests_path(), data=json.dumps(data))
+    res = client.post(gen_requests_path(), data=json.dumps(data))
     return unwrap_response(res, code, data)
 
 def delete_request(request_id, code=202):
-    res = requests.delete(gen_requests_path(request_id))
+    res = client.delete(gen_requests_path(request_id))
     return unwrap_response(res, code)
 
 def respond_to_request(request_id, data, code=200):
-    res = requests.post(gen_requests_path(request_id), data=json.dumps(data))
+    res = client.post(gen_requests_path(request_id), data=json.dumps(data))
     return unwrap_response(res, code, data)
 
 def respond_to_friend_request():
@@ -326,6 +469,108 @@ def bad_request_checker(sample, create, error, nullable=None):
         assert not body["success"]
         assert body["error"] == error
 
+def exercise_every_route():
+    sender_id, receiver_id, request_id, _ = respond_to_friend_request()
+    get_user()
+    get_user_page(after=sender_id - 1, limit=2)
+    get_user_page(after=sender_id - 1, limit=2, stream=True)
+    get_user(sender_id)
+    get_request(request_id)
+    end_friendship(sender_id, SAMPLE_END_FRIENDSHIP(receiver_id))
+
+    weapon_id = create_weapon()["data"]["id"]
+    get_weapon()
+    get_weapon(weapon_id)
+    character_id = create_character(sender_id)["data"]["id"]
+    prepare_weapon(sender_id, character_id, SAMPLE_CHARACTER_PREPARE(weapon_id))
+    get_character(sender_id, character_id)
+
+    (_, challenger_id), _, battle_id = execute_action_to_completion("Counter", "Attack")
+    ai_battle_id = create_battle(SAMPLE_BATTLE(character_id))["data"]["id"]
+    send_battle_action(ai_battle_id, SAMPLE_BATTLE_ACTION(character_id, "Defend"))
+    send_battle_actions({"actions": [{"bid": ai_battle_id, "actor_id": character_id, "action": "Attack"}]})
+    auto_ai_battle = create_ai_battle()["data"]
+    auto_battle(auto_ai_battle["id"], SAMPLE_AUTO_BATTLE(auto_ai_battle["challenger_id"], "random"))
+    get_battle(battle_id)
+    list(watch_battle(battle_id))
+    get_analytics("matchups/")
+    get_analytics("rounds/")
+    get_analytics("characters/", {"limit": 5})
+    get_analytics(f"characters/{challenger_id}/")
+    get_analytics("weapons/")
+    log_id = create_log(battle_id)["data"]["id"]
+    get_log(battle_id, log_id)
+    delete_log(battle_id, log_id)
+    delete_battle(ai_battle_id)
+
+    request_id = create_request(SAMPLE_REQUEST("friend", sender_id, receiver_id))["data"]["id"]
+    respond_to_request(request_id, SAMPLE_RESPONSE(receiver_id, False))
+    delete_request(request_id)
+    delete_character(sender_id, character_id)
+    delete_weapon(weapon_id)
+    delete_user(sender_id)
+
+class QueryCounter:
+    # Requests are answered in this process, so the engine's events show
+    # every statement and commit a request makes while the block is open
+
+    def __enter__(self):
+        self.statements = []
+        self.commits = 0
+        with app.app_context():
+            self.engine = db.engine
+        event.listen(self.engine, "before_cursor_execute", self.record_statement)
+        event.listen(self.engine, "commit", self.record_commit)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, "before_cursor_execute", self.record_statement)
+        event.remove(self.engine, "commit", self.record_commit)
+
+    def record_statement(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(" ".join(statement.split()))
+
+    def record_commit(self, conn):
+        self.commits += 1
+
+QUERY_COUNTS = {}
+
+def assert_query_budget(label, call, statements, commits):
+    with QueryCounter() as counter:
+        result = call()
+    QUERY_COUNTS[label] = (len(counter.statements), counter.commits, statements, commits)
+    assert len(counter.statements) <= statements and counter.commits <= commits, (
+        f"{label} ran {len(counter.statements)} statements and {counter.commits} commits, "
+        f"over its budget of {statements} and {commits}:\n" + "\n".join(counter.statements))
+    return result
+
+# The if/else ladder dao.calculate_hp_and_atk used before the table-driven kernel
+def reference_hp_and_atk(c_info, o_info):
+    nonnegate = lambda c_hp, o_hp: (0 if c_hp < 0 else c_hp, 0 if o_hp < 0 else o_hp)
+    c_hp, c_act, c_atk = c_info
+    o_hp, o_act, o_atk = o_info
+    if c_act == "Attack":
+        if o_act == "Attack":
+            return nonnegate(c_hp - o_atk, o_hp - c_atk), c_atk, o_atk
+        if o_act == "Defend":
+            return nonnegate(c_hp, o_hp - 0.5 * c_atk), 0.5 * c_atk, 0
+        if o_act == "Counter":
+            return nonnegate(c_hp - 2 * o_atk, o_hp), 0, 2 * o_atk
+    elif c_act == "Defend":
+        if o_act == "Attack":
+            return nonnegate(c_hp - 0.5 * o_atk, o_hp), 0, 0.5 * o_atk
+        if o_act == "Defend":
+            return (c_hp, o_hp), 0, 0
+        if o_act == "Counter":
+            return nonnegate(c_hp, o_hp - c_atk), c_atk, 0
+    elif c_act == "Counter":
+        if o_act == "Attack":
+            return nonnegate(c_hp, o_hp - 2 * c_atk), 2 * c_atk, 0
+        if o_act == "Defend":
+            return nonnegate(c_hp - o_atk, o_hp), 0, o_atk
+        if o_act == "Counter":
+            return (c_hp, o_hp), 0, 0
+
 most_recent_log = lambda logs: reduce(lambda x, y: x if x["id"] > y["id"] else y, logs)
 
 # Response handler for unwrapping jsons, provides more useful error messages
@@ -358,7 +603,7 @@ def unwrap_response(response, code, body={}):
             method handler for this route!
             """)
 
-class TestRoutes(unittest.TestCase):
+class TestRoutes(DatabaseTestCase):
     
     ###########
     #  USERS  #
@@ -368,6 +613,34 @@ class TestRoutes(unittest.TestCase):
 
     def test_get_initial_users(self):
         assert get_user()["success"]
+
+    def test_get_users_page(self):
+        first_id = create_user()["data"]["id"]
+        second_id = create_user(sample_type=2)["data"]["id"]
+        third_id = create_user()["data"]["id"]
+
+        body = get_user_page(after=first_id, limit=1)
+        assert body["success"]
+        assert [user["id"] for user in body["data"]] == [second_id]
+        assert body["next_after"] == second_id
+
+        body = get_user_page(after=body["next_after"], limit=2)
+        assert [user["id"] for user in body["data"]] == [third_id]
+        assert body["next_after"] is None
+
+    def test_stream_users(self):
+        first_id = create_user()["data"]["id"]
+        second_id = create_user(sample_type=2)["data"]["id"]
+
+        users = get_user_page(after=first_id - 1, limit=1, stream=True)
+        assert [user["id"] for user in users][:2] == [first_id, second_id]
+        assert users[1]["username"] == SAMPLE_USER_TWO["username"]
+
+    def test_get_users_page_bad_request(self):
+        for after, limit in [("bad", 1), (-1, 1), (0, 0), (0, 1001), (0, "bad")]:
+            body = get_user_page(after, limit, code=400)
+            assert not body["success"]
+            assert body["error"] == USER_PAGE_BAD_REQUEST
     
     # Create a user
 
@@ -388,6 +661,26 @@ class TestRoutes(unittest.TestCase):
         user_id = create_user()["data"]["id"]
         assert get_user(user_id)["success"]
 
+    def test_responses_are_json(self):
+        user_id = create_user()["data"]["id"]
+        for res in [client.get(gen_users_path(user_id)), client.get(gen_users_path(100000)),
+                    client.post(gen_users_path(), data=json.dumps(SAMPLE_USER_ONE))]:
+            assert res.headers["Content-Type"] == "application/json"
+
+    def test_get_user_etag(self):
+        user_id, friend_id, _, _ = respond_to_friend_request()
+        etag = get_etag(gen_users_path(user_id))
+        conditional_get(gen_users_path(user_id), etag)
+
+        # A friend's new character and a new weapon both change what the user shows
+        create_character(friend_id)
+        res = conditional_get(gen_users_path(user_id), etag, 200)
+        assert res.headers["ETag"] != etag
+        assert res.json()["data"]["friends"][0]["characters"] != []
+        etag = res.headers["ETag"]
+        create_weapon()
+        assert conditional_get(gen_users_path(user_id), etag, 200).headers["ETag"] != etag
+
     def test_get_invalid_user(self):
         body = get_user(100000, 404)
         assert not body["success"]
@@ -660,6 +953,40 @@ class TestRoutes(unittest.TestCase):
         weapon_id = create_weapon()["data"]["id"]
         assert get_weapon(weapon_id)["success"]
 
+    def test_get_all_weapons_etag(self):
+        etag = get_etag(gen_weapons_path())
+        conditional_get(gen_weapons_path(), etag)
+
+        weapon_id = create_weapon()["data"]["id"]
+        res = conditional_get(gen_weapons_path(), etag, 200)
+        assert weapon_id in [weapon["id"] for weapon in res.json()["data"]]
+        etag = res.headers["ETag"]
+        delete_weapon(weapon_id)
+        assert conditional_get(gen_weapons_path(), etag, 200).headers["ETag"] != etag
+
+    def test_weapon_cache_counts(self):
+        weapon_id = create_weapon()["data"]["id"]
+        hits, misses = weapon_cache.hits, weapon_cache.misses
+        get_weapon(weapon_id)
+        get_weapon(weapon_id)
+        assert (weapon_cache.hits, weapon_cache.misses) == (hits + 1, misses + 1)
+
+    def test_weapon_cache_sees_other_workers(self):
+        weapon_id = create_weapon()["data"]["id"]
+        user_id = create_user()["data"]["id"]
+        character_id = create_character(user_id)["data"]["id"]
+        prepare_weapon(user_id, character_id, SAMPLE_CHARACTER_PREPARE(weapon_id))
+        assert get_character(user_id, character_id)["data"]["equipped"]["id"] == weapon_id
+
+        # Deleted the way another worker process would, without this one's cache knowing
+        with app.app_context():
+            Weapon.query.filter_by(id=weapon_id).delete()
+            dao.touch_catalog(WEAPON_CATALOG)
+            db.session.commit()
+        assert get_weapon(weapon_id, 404)["error"] == WEAPON_NOT_FOUND
+        assert get_character(user_id, character_id)["data"]["equipped"] is None
+        assert weapon_id not in [weapon["id"] for weapon in get_weapon()["data"]]
+
     def test_get_invalid_weapon(self):
         body = get_weapon(100000, 404)
         assert not body["success"]
@@ -774,6 +1101,29 @@ class TestRoutes(unittest.TestCase):
         assert not body["success"]
         assert body["error"] == BATTLE_SAME_FORBIDDEN
 
+    def test_finished_battle_frees_battlers(self):
+        (_, challenger_id), (_, opponent_id), _ = execute_action_to_completion("Counter", "Attack")
+        assert create_battle(SAMPLE_BATTLE(challenger_id))["success"]
+        assert create_battle(SAMPLE_BATTLE(opponent_id))["success"]
+
+    def test_deleted_battle_frees_battlers(self):
+        battle = create_ai_battle()["data"]
+        delete_battle(battle["id"])
+        assert create_battle(SAMPLE_BATTLE(battle["challenger_id"]))["success"]
+
+    def test_check_active_battles(self):
+        battle = create_ai_battle()["data"]
+        with app.app_context():
+            Character.query.filter_by(id=battle["challenger_id"]).update({"active_battle_id": None})
+            db.session.commit()
+            mismatches = dao.check_active_battles(repair=True)
+            assert {"id": battle["challenger_id"], "active_battle_id": None,
+                    "expected": battle["id"]} in mismatches
+            assert dao.check_active_battles(repair=False) == []
+
+        body = create_battle(SAMPLE_BATTLE(battle["challenger_id"]), 403)
+        assert body["error"] == BATTLE_CHALLENGER_FORBIDDEN
+
     def test_create_battle_invalid_challenger(self):
         opponent_user_id = create_user()["data"]["id"]
         opponent_id = create_character(opponent_user_id)["data"]["id"]
@@ -798,6 +1148,44 @@ class TestRoutes(unittest.TestCase):
         battle_id = create_pvp_battle()["data"]["id"]
         assert get_battle(battle_id)["success"]
 
+    def test_get_battle_logs_in_order(self):
+        (_, challenger_id), (_, opponent_id), battle_id = execute_action_to_completion("Attack", "Counter")
+        logs = get_battle(battle_id)["data"]["logs"]
+        assert [log["id"] for log in logs] == sorted(log["id"] for log in logs)
+        assert logs[0]["action"].startswith("The battle between")
+        assert logs[-1] == most_recent_log(logs)
+
+    def test_get_battle_etag(self):
+        (_, challenger_id), (_, opponent_id), _, battle_id = respond_to_battle_request()
+        etag = get_etag(gen_battles_path(battle_id))
+        conditional_get(gen_battles_path(battle_id), etag)
+
+        # Half a round changes nothing the battle shows
+        send_battle_action(battle_id, SAMPLE_BATTLE_ACTION(challenger_id, "Attack"))
+        conditional_get(gen_battles_path(battle_id), etag)
+
+        send_battle_action(battle_id, SAMPLE_BATTLE_ACTION(opponent_id, "Attack"))
+        res = conditional_get(gen_battles_path(battle_id), etag, 200)
+        assert len(res.json()["data"]["logs"]) == 2
+        etag = res.headers["ETag"]
+        delete_log(battle_id, res.json()["data"]["logs"][-1]["id"])
+        assert conditional_get(gen_battles_path(battle_id), etag, 200).headers["ETag"] != etag
+
+    def test_battle_metrics(self):
+        battle_id = create_pvp_battle()["data"]["id"]
+        route = '/api/battles/<int:bid>/'
+        request_count = f'ai_request_duration_seconds_count{{method="GET",route="{route}",status="200"}}'
+        dao_count = f'ai_dao_call_queries_count{{route="{route}",function="get_battle"}}'
+        before = get_metrics()
+        get_battle(battle_id)
+        get_battle(battle_id)
+
+        after = get_metrics()
+        assert after[request_count] == before.get(request_count, 0) + 2
+        assert after[dao_count] == before.get(dao_count, 0) + 2
+        assert after[f'ai_request_queries_sum{{method="GET",route="{route}"}}'] > 0
+        assert "ai_weapon_cache_hits_total" in after
+
     def test_get_invalid_battle(self):
         body = get_battle(100000, 404)
         assert not body["success"]
@@ -854,6 +1242,109 @@ class TestRoutes(unittest.TestCase):
         recent_log = most_recent_log(done_battle["logs"])
         assert recent_log["action"] == LOG_DRAW_ACTION
 
+    def test_logs_are_stored_structured(self):
+        _, _, battle_id = execute_action_to_completion("Attack", "Defend")
+        create_log(battle_id)
+        with app.app_context():
+            logs = Log.query.filter_by(battle_id=battle_id).order_by(Log.id).all()
+            kinds = [log.kind for log in logs]
+            assert kinds[0] == LOG_START and kinds[-2] == LOG_WIN and kinds[-1] == LOG_CUSTOM
+            assert set(kinds[1:-2]) == {LOG_ROUND}
+            assert [log.round for log in logs[:-1]] == list(range(len(logs) - 2)) + [len(logs) - 3]
+            # Only the posted log keeps any text
+            assert [log.action for log in logs] == [None] * (len(logs) - 1) + [SAMPLE_LOG["action"]]
+            assert logs[1].challenger_action == combat.ACTION_CODES["Attack"]
+            assert logs[1].opponent_dealt == 0
+
+    def test_analytics_count_finished_battles(self):
+        (_, challenger_id), (_, opponent_id), battle_id = execute_action_to_completion("Counter", "Attack")
+        rounds = len(get_battle(battle_id)["data"]["logs"]) - 2
+        challenger = get_analytics(f"characters/{challenger_id}/")["data"]
+        assert (challenger["battles"], challenger["wins"], challenger["losses"]) == (1, 1, 0)
+        assert challenger["win_rate"] == 1 and challenger["mean_rounds"] == rounds
+        opponent = get_analytics(f"characters/{opponent_id}/")["data"]
+        assert (opponent["battles"], opponent["wins"], opponent["losses"]) == (1, 0, 1)
+
+        matchups = {(m["challenger_action"], m["opponent_action"]): m for m in get_analytics("matchups/")["data"]}
+        assert len(matchups) == 9
+        counter_attack = matchups["Counter", "Attack"]
+        assert counter_attack["rounds"] == rounds and counter_attack["win_rate"] == 1
+        assert counter_attack["challenger_mean_dealt"] == 2 * ATK and counter_attack["opponent_mean_dealt"] == 0
+        assert sum(m["rounds"] for m in matchups.values()) == rounds
+        assert sum(m["battles_decided"] for m in matchups.values()) == 1
+
+        histogram = get_analytics("rounds/")["data"]
+        assert histogram["battles"] == 1 and histogram["mean_rounds"] == rounds
+        assert [b["battles"] for b in histogram["buckets"] if b["le"] == rounds] == [1]
+        assert [c["id"] for c in get_analytics("characters/", {"limit": 1})["data"]] == [challenger_id]
+
+    def test_analytics_match_rebuild(self):
+        weapon_id = create_weapon()["data"]["id"]
+        user_id = create_user()["data"]["id"]
+        character_id = create_character(user_id)["data"]["id"]
+        prepare_weapon(user_id, character_id, SAMPLE_CHARACTER_PREPARE(weapon_id))
+        for strategy in ["Attack", "Counter", "random"]:
+            battle = create_battle(SAMPLE_BATTLE(character_id))["data"]
+            auto_battle(battle["id"], SAMPLE_AUTO_BATTLE(character_id, strategy))
+        execute_action_to_completion("Attack", "Attack")
+        execute_action_to_completion("Attack", "Defend")
+
+        # Counted as each battle ended, then recounted from the whole history
+        paths = ["matchups/", "rounds/", "weapons/", f"characters/{character_id}/"]
+        counted = [get_analytics(path)["data"] for path in paths]
+        assert counted[2][0]["battles"] == 3 and counted[1]["battles"] == 5
+        with app.app_context():
+            dao.rebuild_analytics(db.session.connection())
+            db.session.commit()
+        assert [get_analytics(path)["data"] for path in paths] == counted
+
+    def test_analytics_errors(self):
+        get_analytics("characters/1/", code=404)
+        get_analytics("characters/", {"limit": 0}, code=400)
+
+    def test_ai_moves_follow_seed(self):
+        battle = create_ai_battle()["data"]
+        done_battle = auto_battle(battle["id"], SAMPLE_AUTO_BATTLE(battle["challenger_id"], "random"))["data"]
+        with app.app_context():
+            stored = Battle.query.filter_by(id=battle["id"]).first()
+            assert len(stored.actions) == 2 * stored.round
+            for round in range(stored.round):
+                rng = dao.round_rng(stored.seed, round)
+                moves = dao.ai_action(rng), dao.ai_action(rng)
+                codes = stored.actions[2 * round:2 * round + 2]
+                assert codes == "".join(str(combat.ACTION_CODES[move]) for move in reversed(moves))
+            ids = [log["id"] for log in done_battle["logs"]]
+            timestamps = [log["timestamp"] for log in done_battle["logs"]]
+            assert [log.serialize() for log in stored.replay_logs(ids, timestamps)] == done_battle["logs"]
+
+    def test_archived_battles_replay(self):
+        _, _, pvp_id = execute_action_to_completion("Counter", "Attack")
+        battle = create_ai_battle()["data"]
+        auto_battle(battle["id"], SAMPLE_AUTO_BATTLE(battle["challenger_id"], "Attack"))
+        _, _, posted_id = execute_action_to_completion("Attack", "Defend")
+        create_log(posted_id)
+        battles = [get_battle(bid)["data"] for bid in (pvp_id, battle["id"], posted_id)]
+        matchups = get_analytics("matchups/")["data"]
+
+        # Replaying can't bring back a posted log, so that battle keeps its rows
+        with app.app_context():
+            assert dao.archive_battles() == (2, 1)
+            assert Log.query.filter(Log.battle_id.in_([pvp_id, battle["id"]])).count() == 0
+            dao.rebuild_analytics(db.session.connection())
+            db.session.commit()
+        assert [get_battle(b["id"])["data"] for b in battles] == battles
+        assert get_analytics("matchups/")["data"] == matchups
+        logs = battles[0]["logs"]
+        assert get_log(pvp_id, logs[1]["id"])["data"] == logs[1]
+        assert list(watch_battle(pvp_id, after=logs[0]["id"])) == [("log", log) for log in logs[1:]] + [("done", {})]
+
+        # Changing a log puts the rest back as rows first
+        delete_log(pvp_id, logs[1]["id"])
+        assert get_battle(pvp_id)["data"]["logs"] == logs[:1] + logs[2:]
+        with app.app_context():
+            assert Log.query.filter_by(battle_id=pvp_id).count() == len(logs) - 1
+            assert dao.archive_battles() == (0, 2)
+
     def test_attack_attack_combo(self):
         c_name, c_act, c_atk, o_name, o_act, o_atk, log = execute_action("Attack", "Attack")
         assert log["challenger_hp"] == MHP - o_atk
@@ -910,6 +1401,143 @@ class TestRoutes(unittest.TestCase):
 
     ## Game logic tests END
 
+    # Send battle actions in bulk
+
+    def test_send_battle_actions(self):
+        (_, first_challenger), (_, first_opponent), _, first_bid = respond_to_battle_request()
+        (_, second_challenger), (_, second_opponent), _, second_bid = respond_to_battle_request()
+        ai_battle = create_ai_battle()["data"]
+        entries = [
+            {"bid": first_bid, "actor_id": first_challenger, "action": "Attack"},
+            {"bid": first_bid, "actor_id": first_challenger, "action": "Attack"},
+            {"bid": second_bid, "actor_id": second_challenger, "action": "Defend"},
+            {"bid": first_bid, "actor_id": first_opponent, "action": "Attack"},
+            {"bid": second_bid, "actor_id": second_opponent, "action": "Counter"},
+            {"bid": ai_battle["id"], "actor_id": ai_battle["challenger_id"], "action": "Defend"},
+            {"bid": 100000, "actor_id": first_challenger, "action": "Attack"},
+            {"bid": first_bid, "actor_id": 100000, "action": "Attack"},
+            {"bid": first_bid, "actor_id": second_challenger, "action": "Attack"},
+            {"bid": first_bid, "actor_id": first_challenger, "action": "Dance"},
+            {"bid": first_bid, "actor_id": "bad", "action": "Attack"},
+        ]
+        body = send_battle_actions({"actions": entries})
+        assert body["success"]
+        assert [item["code"] for item in body["data"]] == [202, 403, 202, 202, 202, 202, 404, 404, 403, 400, 400]
+        assert body["data"][0]["data"] == BATTLE_ACTION_ACCEPTED
+        assert body["data"][1]["error"] == BATTLE_ACTION_ALREADY_FORBIDDEN
+        assert body["data"][6]["error"] == BATTLE_ACTION_BATTLE_NOT_FOUND
+        assert body["data"][7]["error"] == CHARACTER_NOT_FOUND
+        assert body["data"][8]["error"] == BATTLE_ACTION_CHARACTER_FORBIDDEN
+        assert body["data"][9]["error"] == BATTLE_ACTION_BAD_REQUEST_ACTION
+        assert body["data"][10]["error"] == BATCH_ACTIONS_BAD_ITEM
+
+        first_log = most_recent_log(get_battle(first_bid)["data"]["logs"])
+        assert first_log["challenger_hp"] == MHP - ATK
+        assert first_log["opponent_hp"] == MHP - ATK
+        second_log = most_recent_log(get_battle(second_bid)["data"]["logs"])
+        assert second_log["opponent_hp"] == MHP - ATK
+        assert len(get_battle(ai_battle["id"])["data"]["logs"]) == 2
+
+    def test_send_battle_actions_bad_request(self):
+        for data in [{}, {"actions": "Attack"}, {"actions": []}, {"actions": [{}] * 501}]:
+            body = send_battle_actions(data, 400)
+            assert not body["success"]
+            assert body["error"] == BATCH_ACTIONS_BAD_REQUEST
+
+    # Auto-battle against the AI
+
+    def test_auto_battle(self):
+        for strategy in ["Attack", "Defend", "Counter", "random"]:
+            battle = create_ai_battle()["data"]
+            challenger_id = battle["challenger_id"]
+            body = auto_battle(battle["id"], SAMPLE_AUTO_BATTLE(challenger_id, strategy))
+            done_battle = body["data"]
+            assert body["success"]
+            assert done_battle["done"]
+            assert done_battle == get_battle(battle["id"])["data"]
+
+            logs = done_battle["logs"]
+            assert logs[0] == battle["logs"][0]
+            assert all(f"Challenger {SAMPLE_CHARACTER_ONE['name']} used" in log["action"] for log in logs[1:-1])
+            if strategy != "random":
+                assert all(f"used {strategy}" in log["action"] for log in logs[1:-1])
+            assert logs[-1]["action"] in [LOG_WINNER_ACTION(SAMPLE_CHARACTER_ONE["name"]),
+                                          LOG_WINNER_ACTION("AI"), LOG_DRAW_ACTION]
+            assert create_battle(SAMPLE_BATTLE(challenger_id))["success"]
+
+    def test_watch_finished_battle(self):
+        _, _, bid = execute_action_to_completion("Counter", "Attack")
+        logs = get_battle(bid)["data"]["logs"]
+        events = list(watch_battle(bid))
+        assert events == [("log", log) for log in logs] + [("done", {})]
+
+        events = list(watch_battle(bid, after=logs[1]["id"]))
+        assert events == [("log", log) for log in logs[2:]] + [("done", {})]
+
+    def test_watch_live_battle(self):
+        battle = create_pvp_battle()["data"]
+        events = watch_battle(battle["id"])
+        assert next(events) == ("log", battle["logs"][0])
+
+        chal_act = SAMPLE_BATTLE_ACTION(battle["challenger_id"], "Counter")
+        o_act = SAMPLE_BATTLE_ACTION(battle["opponent_id"], "Attack")
+        send_battle_action(battle["id"], chal_act)
+        send_battle_action(battle["id"], o_act)
+        logs = get_battle(battle["id"])["data"]["logs"]
+        assert next(events) == ("log", logs[1])
+
+        while not get_battle(battle["id"])["data"]["done"]:
+            send_battle_actions({"actions": [dict(chal_act, bid=battle["id"]), dict(o_act, bid=battle["id"])]})
+        logs = get_battle(battle["id"])["data"]["logs"]
+        assert list(events) == [("log", log) for log in logs[2:]] + [("done", {})]
+
+    def test_watch_auto_battle(self):
+        battle = create_ai_battle()["data"]
+        events = watch_battle(battle["id"])
+        assert next(events) == ("log", battle["logs"][0])
+
+        done_battle = auto_battle(battle["id"], SAMPLE_AUTO_BATTLE(battle["challenger_id"], "random"))["data"]
+        assert list(events) == [("log", log) for log in done_battle["logs"][1:]] + [("done", {})]
+
+    def test_watch_stream_limit(self):
+        battle = create_pvp_battle()["data"]
+        watchers = [watch_battle(battle["id"]) for _ in range(app.config["MAX_EVENT_STREAMS"])]
+        for events in watchers:
+            assert next(events) == ("log", battle["logs"][0])
+        body = watch_battle(battle["id"], code=503)
+        assert not body["success"]
+
+        # Hanging up frees the stream for someone else
+        watchers.pop().close()
+        assert next(watch_battle(battle["id"])) == ("log", battle["logs"][0])
+
+    def test_watch_invalid_battle(self):
+        body = watch_battle(1000, code=404)
+        assert not body["success"]
+        assert body["error"] == BATTLE_NOT_FOUND
+
+    def test_auto_battle_bad_request(self):
+        battle = create_ai_battle()["data"]
+        sample = SAMPLE_AUTO_BATTLE(battle["challenger_id"], "random")
+        wrapper = lambda data, code: auto_battle(battle["id"], data, code)
+        bad_request_checker(sample, wrapper, AUTO_BATTLE_BAD_REQUEST)
+
+        body = auto_battle(battle["id"], SAMPLE_AUTO_BATTLE(battle["challenger_id"], "Dance"), 400)
+        assert body["error"] == AUTO_BATTLE_BAD_REQUEST_STRATEGY
+
+    def test_auto_battle_pvp_forbidden(self):
+        (_, challenger_id), _, _, battle_id = respond_to_battle_request()
+        body = auto_battle(battle_id, SAMPLE_AUTO_BATTLE(challenger_id, "Attack"), 403)
+        assert not body["success"]
+        assert body["error"] == AUTO_BATTLE_PVP_FORBIDDEN
+
+    def test_auto_battle_done_forbidden(self):
+        battle = create_ai_battle()["data"]
+        sample = SAMPLE_AUTO_BATTLE(battle["challenger_id"], "Counter")
+        auto_battle(battle["id"], sample)
+        body = auto_battle(battle["id"], sample, 403)
+        assert body["error"] == BATTLE_ACTION_DONE_FORBIDDEN
+
     def test_send_battle_action_bad_request(self):
         (_, challenger_id), _, _, battle_id = respond_to_battle_request()
         sample = SAMPLE_BATTLE_ACTION(challenger_id, "Attack")
@@ -1039,6 +1667,23 @@ class TestRoutes(unittest.TestCase):
         assert not body["success"]
         assert body["error"] == LOG_NOT_FOUND
 
+    def test_newest_log_sets_battle_hp(self):
+        (_, challenger_id), (_, opponent_id), _, battle_id = respond_to_battle_request()
+        log_id = create_log(battle_id)["data"]["id"]
+        send_battle_action(battle_id, SAMPLE_BATTLE_ACTION(challenger_id, "Defend"))
+        send_battle_action(battle_id, SAMPLE_BATTLE_ACTION(opponent_id, "Defend"))
+        recent_log = most_recent_log(get_battle(battle_id)["data"]["logs"])
+        assert recent_log["challenger_hp"] == SAMPLE_LOG["challenger_hp"]
+        assert recent_log["opponent_hp"] == SAMPLE_LOG["opponent_hp"]
+
+        delete_log(battle_id, recent_log["id"])
+        delete_log(battle_id, log_id)
+        send_battle_action(battle_id, SAMPLE_BATTLE_ACTION(challenger_id, "Defend"))
+        send_battle_action(battle_id, SAMPLE_BATTLE_ACTION(opponent_id, "Defend"))
+        recent_log = most_recent_log(get_battle(battle_id)["data"]["logs"])
+        assert recent_log["challenger_hp"] == MHP
+        assert recent_log["opponent_hp"] == MHP
+
     def test_delete_forbidden_log(self):
         first_battle_id = create_ai_battle()["data"]["id"]
         first_log_id = create_log(first_battle_id)["data"]["id"]
@@ -1363,13 +2008,326 @@ class TestRoutes(unittest.TestCase):
         assert not body["success"]
         assert body["error"] == REQUEST_BATTLE_RECEIVER_NOT_FOUND
 
-    
 
-def run_tests():
-    sleep(1.5)
-    unittest.main()
+class TestCombat(unittest.TestCase):
+
+    HPS = [0, 1, 2.5, 7, 10, 14.5, 1000]
+    ATKS = [0, 1, 2, 3, 1339]
+
+    def test_scalar_matches_reference(self):
+        for c_act in combat.ACTIONS:
+            for o_act in combat.ACTIONS:
+                for c_hp in self.HPS:
+                    for o_hp in self.HPS:
+                        for c_atk in self.ATKS:
+                            for o_atk in self.ATKS:
+                                c_info = (c_hp, c_act, c_atk)
+                                o_info = (o_hp, o_act, o_atk)
+                                # repr() also catches 4 turning into 4.0
+                                assert (repr(dao.calculate_hp_and_atk(c_info, o_info)) ==
+                                        repr(reference_hp_and_atk(c_info, o_info))), (c_info, o_info)
+
+    def test_batch_matches_scalar(self):
+        rng = np.random.default_rng(2020)
+        size = 5000
+        c_hp, o_hp = rng.integers(0, 100, size), rng.integers(0, 100, size)
+        c_atk, o_atk = rng.integers(0, 20, size), rng.integers(0, 20, size)
+        c_act, o_act = rng.integers(0, 3, size), rng.integers(0, 3, size)
+        batch = combat.resolve_batch(c_hp, c_act, c_atk, o_hp, o_act, o_atk)
+        for i in range(size):
+            (c, o), c_dealt, o_dealt = reference_hp_and_atk(
+                (int(c_hp[i]), combat.ACTIONS[c_act[i]], int(c_atk[i])),
+                (int(o_hp[i]), combat.ACTIONS[o_act[i]], int(o_atk[i])))
+            assert [c, o, c_dealt, o_dealt] == [column[i] for column in batch]
+
+    def test_simulate_fixed_policies(self):
+        stats = simulate.stats_at(0, 0, MHP_INCREMENT, ATK_INCREMENT)
+        assert stats == (MHP, ATK)
+        outcomes, histogram = simulate.simulate_chunk((stats, stats, "Counter", "Attack", 100, 50, 0))
+        assert outcomes[simulate.WIN] == 100
+        # 10 HP against 2 * 2 damage a round
+        assert histogram[3] == 100
+
+        outcomes, _ = simulate.simulate_chunk((stats, stats, "Defend", "Defend", 100, 50, 0))
+        assert outcomes[simulate.UNFINISHED] == 100
+
+class TestQueryCounts(DatabaseTestCase):
+    # Budgets hold however much data is involved, so N+1 loading or an extra
+    # commit on one of these hot paths fails here
+
+    @classmethod
+    def tearDownClass(cls):
+        print("\nqueries per request (statements/commits, budget):", file=sys.stderr)
+        for label, (statements, commits, statement_budget, commit_budget) in sorted(QUERY_COUNTS.items()):
+            print(f"  {label:<28} {statements}/{commits}  ({statement_budget}/{commit_budget})", file=sys.stderr)
+
+    def test_user_list(self):
+        user_ids = []
+        for _ in range(20):
+            weapon_id = create_weapon()["data"]["id"]
+            user_id = create_user()["data"]["id"]
+            character_id = create_character(user_id)["data"]["id"]
+            prepare_weapon(user_id, character_id, SAMPLE_CHARACTER_PREPARE(weapon_id))
+            if user_ids:
+                request_id = create_request(SAMPLE_REQUEST("friend", user_ids[-1], user_id))["data"]["id"]
+                respond_to_request(request_id, SAMPLE_RESPONSE(user_id, True))
+            user_ids.append(user_id)
+
+        # Measured cold, as after any weapon change or in a new worker, where
+        # every equipped weapon has to be read
+        with app.app_context():
+            weapon_cache.invalidate()
+        users = assert_query_budget("GET users", lambda: get_user_page(after=user_ids[0] - 1, limit=20), 6, 0)
+        assert [user["id"] for user in users["data"]] == user_ids
+
+    def test_battle_get(self):
+        _, _, battle_id = execute_action_to_completion("Defend", "Attack")
+        battle = assert_query_budget("GET battle", lambda: get_battle(battle_id), 3, 0)
+        assert len(battle["data"]["logs"]) > 5
+
+    def test_battle_action(self):
+        (_, challenger_id), (_, opponent_id), _, battle_id = respond_to_battle_request()
+        chal_act = SAMPLE_BATTLE_ACTION(challenger_id, "Counter")
+        o_act = SAMPLE_BATTLE_ACTION(opponent_id, "Attack")
+        assert_query_budget("POST battle action (waiting)", lambda: send_battle_action(battle_id, chal_act), 4, 1)
+        assert_query_budget("POST battle action (round)", lambda: send_battle_action(battle_id, o_act), 7, 1)
+        # Counter beats Attack by double damage, so the third round wins
+        send_battle_action(battle_id, chal_act)
+        send_battle_action(battle_id, o_act)
+        send_battle_action(battle_id, chal_act)
+        assert_query_budget("POST battle action (win)", lambda: send_battle_action(battle_id, o_act), 16, 1)
+        assert get_battle(battle_id)["data"]["done"]
+
+    def test_request_respond(self):
+        request_id = create_request(build_request("friend"))["data"]["id"]
+        receiver_id = get_request(request_id)["data"]["receiver_id"]
+        assert_query_budget("POST respond (friend)",
+                            lambda: respond_to_request(request_id, SAMPLE_RESPONSE(receiver_id, True)), 12, 1)
+
+        request_id = create_request(build_request("battle"))["data"]["id"]
+        receiver_id = get_request(request_id)["data"]["receiver_id"]
+        assert_query_budget("POST respond (battle)",
+                            lambda: respond_to_request(request_id, SAMPLE_RESPONSE(receiver_id, True)), 13, 1)
+
+class TestSerializer(unittest.TestCase):
+
+    PAYLOAD = {"success": False, "error": USER_END_FRIENDSHIP_FORBIDDEN_INVALID,
+               "data": [{"id": 1, "hp": 0.5, "done": True, "opponent_id": None, "logs": []}]}
+
+    def test_backends_agree(self):
+        for backend, (dumps, loads) in serializer.BACKENDS.items():
+            encoded = dumps(self.PAYLOAD)
+            assert type(encoded) == bytes, backend
+            assert json.loads(encoded) == self.PAYLOAD, backend
+            assert loads(encoded) == loads(encoded.decode()) == self.PAYLOAD, backend
+
+    def test_prefers_orjson(self):
+        assert serializer.BACKEND == ("orjson" if serializer.orjson is not None else "json")
+
+class TestMetrics(DatabaseTestCase):
+
+    def test_histogram_render(self):
+        histogram = metrics.Histogram("test_seconds", "Test.", ("route",), (0.005, 1))
+        histogram.observe(("/a",), 0.003)
+        histogram.observe(("/a",), 7)
+        assert histogram.render() == [
+            "# HELP test_seconds Test.",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{route="/a",le="0.005"} 1',
+            'test_seconds_bucket{route="/a",le="1"} 1',
+            'test_seconds_bucket{route="/a",le="+Inf"} 2',
+            'test_seconds_sum{route="/a"} 7.003',
+            'test_seconds_count{route="/a"} 2',
+        ]
+
+    def test_only_entry_points_timed(self):
+        battle = create_ai_battle()["data"]
+        auto_battle(battle["id"], SAMPLE_AUTO_BATTLE(battle["challenger_id"], "random"))
+        functions = {sample.split('function="')[1].split('"')[0] for sample in get_metrics()
+                     if sample.startswith("ai_dao_call_queries_count")}
+        assert {"create_battle", "auto_battle"} <= functions
+        assert not functions & {"resolve_round", "round_rng", "build_log", "touch_battle"}
+
+    def test_metrics_need_an_allowed_address(self):
+        res = client.get("/api/_metrics", environ_base={"REMOTE_ADDR": "203.0.113.9"})
+        assert res.status_code == 403
+
+class TestDatabaseConfig(unittest.TestCase):
+
+    def test_sqlite_pragmas(self):
+        # The suite's own database is in memory, where WAL doesn't apply
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(f"sqlite:///{directory}/ai.db")
+            set_sqlite_pragmas(engine, config.SQLITE_PRAGMAS)
+            with engine.connect() as connection:
+                pragma = lambda name: connection.execute(text(f"PRAGMA {name}")).scalar()
+                assert pragma("journal_mode") == "wal"
+                assert pragma("synchronous") == 1 # NORMAL
+                assert pragma("busy_timeout") == config.SQLITE_PRAGMAS["busy_timeout"]
+                assert pragma("cache_size") == config.SQLITE_PRAGMAS["cache_size"]
+            engine.dispose()
+
+    def test_engine_options(self):
+        options = lambda uri: config.engine_options(dict(vars(config.Config), SQLALCHEMY_DATABASE_URI=uri))
+        assert options("sqlite:///ai.db") == {}
+        assert options("postgresql://localhost/ai")["pool_size"] == config.Config.DB_POOL_SIZE
+        assert options("postgresql://localhost/ai")["pool_pre_ping"]
+
+class TestSeed(DatabaseTestCase):
+
+    def seed_and_dump(self):
+        reset_database()
+        with app.app_context():
+            with db.engine.begin() as conn:
+                counts = seed.seed(conn, users=50, weapons=10, characters_per_user=2, friends=3,
+                                   max_friends=20, battles=200, seed=7, batch_size=64)
+                dump = {table.name: conn.execute(table.select()).fetchall() for table in seed.SEEDED_TABLES}
+        return counts, dump
+
+    def test_deterministic(self):
+        counts, dump = self.seed_and_dump()
+        assert counts["user"] == 50 and counts["weapon"] == 10
+        assert counts["log"] > counts["battle"] > 190
+        assert self.seed_and_dump()[1] == dump
+
+    def test_consistent_with_api(self):
+        self.seed_and_dump()
+        with app.app_context():
+            assert dao.check_active_battles(repair=False) == []
+        user = next(user for user in get_user_page(limit=50)["data"] if user["friends"])
+        friend = get_user(user["friends"][0]["id"])["data"]
+        assert user["id"] in [f["id"] for f in friend["friends"]]
+
+        battle = get_battle(1)["data"]
+        assert battle["done"]
+        assert battle["logs"][0]["action"].startswith("The battle between Challenger")
+        assert "won the battle" in battle["logs"][-1]["action"] or "draw" in battle["logs"][-1]["action"]
+
+        # New rows carry on after the seeded ids
+        assert create_user()["data"]["id"] == 51
+
+class TestUpgrade(DatabaseTestCase):
+
+    # The tables and rows of a database from before any of the columns upgrade.py fills in
+    OLD_DATABASE = """
+        CREATE TABLE user (id INTEGER NOT NULL, username VARCHAR NOT NULL, PRIMARY KEY (id));
+        CREATE TABLE weapon (id INTEGER NOT NULL, name VARCHAR NOT NULL, atk INTEGER NOT NULL, PRIMARY KEY (id));
+        CREATE TABLE character (id INTEGER NOT NULL, name VARCHAR NOT NULL, mhp INTEGER NOT NULL,
+            atk INTEGER NOT NULL, weapon_id INTEGER, user_id INTEGER NOT NULL, PRIMARY KEY (id));
+        CREATE TABLE association (friender_id INTEGER, friendee_id INTEGER);
+        CREATE TABLE request (id INTEGER NOT NULL, kind VARCHAR NOT NULL, user_sender_id INTEGER,
+            user_receiver_id INTEGER, character_sender_id INTEGER, character_receiver_id INTEGER,
+            accepted BOOLEAN, PRIMARY KEY (id));
+        CREATE TABLE battle (id INTEGER NOT NULL, challenger_id INTEGER NOT NULL, opponent_id INTEGER,
+            done BOOLEAN NOT NULL, PRIMARY KEY (id));
+        CREATE TABLE action (id INTEGER NOT NULL, challenger_action VARCHAR, opponent_action VARCHAR,
+            battle_id INTEGER, PRIMARY KEY (id));
+        CREATE TABLE log (id INTEGER NOT NULL, timestamp INTEGER NOT NULL, challenger_hp INTEGER NOT NULL,
+            opponent_hp INTEGER NOT NULL, action VARCHAR NOT NULL, battle_id INTEGER NOT NULL, PRIMARY KEY (id));
+
+        INSERT INTO user VALUES (1, 'chalo2000'), (2, '2000chalo');
+        INSERT INTO weapon VALUES (1, 'Rubber Duck', 3);
+        INSERT INTO character VALUES (1, 'Chalos', 14, 4, 1, 1), (2, 'Solach', 10, 2, NULL, 2);
+        INSERT INTO association VALUES (1, 2), (2, 1);
+        INSERT INTO request VALUES (1, 'friend', 1, 2, NULL, NULL, 1);
+        INSERT INTO battle VALUES (1, 1, 2, 1), (2, 2, NULL, 0);
+        INSERT INTO action VALUES (1, NULL, NULL, 1), (2, NULL, NULL, 2);
+        INSERT INTO log VALUES
+            (1, 100, 14, 10, 'The battle between Challenger Chalos and Opponent Solach has begun.', 1),
+            (2, 200, 14, 0, 'Challenger Chalos used Counter and dealt 14 damage! Opponent Solach used Attack and dealt 0 damage!', 1),
+            (3, 300, 14, 0, 'Chalos has won the battle!!!', 1),
+            (4, 400, 10, 10, 'The battle between Challenger Solach and Opponent AI has begun.', 2),
+            (5, 500, 8, 8, 'Challenger Solach used Attack and dealt 2 damage! Opponent AI used Attack and dealt 2 damage!', 2);
+    """
+
+    def test_old_database_upgrades(self):
+        with tempfile.TemporaryDirectory() as scratch:
+            source = create_engine(f"sqlite:///{scratch}/old.db")
+            with source.begin() as conn:
+                for statement in self.OLD_DATABASE.split(";"):
+                    if statement.strip():
+                        conn.execute(text(statement))
+            with app.app_context(), source.connect() as old, db.engine.begin() as conn:
+                counts = upgrade.upgrade(old, conn)
+            source.dispose()
+        assert counts["log"] == 5 and counts["battle"] == 2 and "catalog" not in counts
+
+        # Old logs read exactly as they were written
+        logs = get_battle(1)["data"]["logs"]
+        assert [log["action"] for log in logs] == [
+            "The battle between Challenger Chalos and Opponent Solach has begun.",
+            "Challenger Chalos used Counter and dealt 14 damage! Opponent Solach used Attack and dealt 0 damage!",
+            "Chalos has won the battle!!!"]
+        assert [(log["id"], log["challenger_hp"], log["opponent_hp"]) for log in logs] == [
+            (1, 14, 10), (2, 14, 0), (3, 14, 0)]
+        assert get_user(1)["data"]["characters"][0]["equipped"]["atk"] == 3
+        assert get_analytics("characters/1/")["data"]["wins"] == 1
+
+        # The battle left going carries on from its newest log
+        body = create_battle(SAMPLE_BATTLE(2), code=403)
+        assert body["error"] == BATTLE_CHALLENGER_FORBIDDEN
+        send_battle_action(2, SAMPLE_BATTLE_ACTION(2, "Defend"))
+        log = get_battle(2)["data"]["logs"][-1]
+        assert log["id"] == 6 and log["challenger_hp"] in (7, 8) and log["opponent_hp"] in (6, 8)
+        assert create_user()["data"]["id"] == 3
+
+        # Text logs can't be replayed, so the old battle keeps them
+        with app.app_context():
+            assert dao.archive_battles() == (0, 1)
+
+class TestLoadTest(DatabaseTestCase):
+
+    def test_every_scenario(self):
+        import loadtest
+        suite = loadtest.load_suite()
+        mix = {name: 1 for name in loadtest.SCENARIOS}
+        with loadtest.serving(loadtest.TimedClient(lambda: suite.ApiClient(app))) as timed:
+            result = loadtest.run(mix, 1, 60, 10, 0, timed)
+        assert suite.client is not timed
+        assert result["scenarios"] == 10
+        assert result["failures"] == []
+        assert all(route["errors"] == 0 for route in result["routes"].values())
+        assert "POST /api/battles/<int:bid>/" in result["routes"]
+
+class TestQueryPlans(DatabaseTestCase):
+
+    # Listing the whole weapon catalog is the one query meant to read a full
+    # table, besides the analytics tables with a fixed handful of rows. The
+    # leaderboard walks the wins index only as far as its limit.
+    # As (table, index) pairs, since the plan's wording differs between
+    # SQLite versions: older ones print "SCAN TABLE weapon"
+    FULL_SCANS_ALLOWED = [("weapon", None), ("CONSTANT ROW", None), ("round_stat", None),
+                          ("matchup_stat", "sqlite_autoindex_matchup_stat_1"),
+                          ("character", "ix_character_wins")]
+    SCAN_DETAIL = re.compile(r"SCAN (?:TABLE )?(CONSTANT ROW|\S+)(?: AS \S+)?(?: USING (?:COVERING )?INDEX (\S+))?")
+
+    def test_no_full_table_scans(self):
+        statements = {}
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+                statements.setdefault(statement, parameters[0] if executemany else parameters)
+
+        with app.app_context():
+            event.listen(db.engine, "before_cursor_execute", record)
+            try:
+                exercise_every_route()
+            finally:
+                event.remove(db.engine, "before_cursor_execute", record)
+
+            connection = db.engine.raw_connection()
+            try:
+                cursor = connection.cursor()
+                scans = []
+                for statement, parameters in statements.items():
+                    cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+                    details = [row[-1] for row in cursor.fetchall()]
+                    scans += [(detail, statement) for detail in details if detail.startswith("SCAN ")
+                              and self.SCAN_DETAIL.match(detail).groups() not in self.FULL_SCANS_ALLOWED]
+            finally:
+                connection.close()
+
+        assert len(statements) > 0
+        assert scans == [], "\n".join(f"{detail}: {statement}" for detail, statement in scans)
 
 if __name__ == "__main__":
-    thread = Thread(target=run_tests)
-    thread.start()
-    app.run(host="0.0.0.0", port=5000, debug=False)
+    unittest.main()
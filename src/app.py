@@ -1,28 +1,56 @@
 import json
-from flask import Flask, request
+import click
+import queue
+import threading
+from flask import Flask, Response, request, stream_with_context
+from werkzeug.http import quote_etag
+from broadcast import broadcaster
+import broadcast
+import config
 import dao
-from db import db
+import metrics
+import serializer
+from db import db, set_sqlite_pragmas, weapon_cache
 
 app = Flask(__name__)
-db_filename = "ai.db"
-
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = False
+app.config.from_object(config.Config)
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = config.engine_options(app.config)
 
 db.init_app(app)
 with app.app_context():
+    set_sqlite_pragmas(db.engine, app.config["SQLITE_PRAGMAS"])
     db.create_all()
+    metrics.init_app(app, db.engine)
+
+# Every DAO function a route calls, the ones whose cost a request is made of
+metrics.instrument(dao, [
+    "get_all_users", "create_user", "get_user", "get_user_etag", "delete_user", "end_friendship",
+    "create_character", "get_character", "delete_character", "prepare_weapon",
+    "get_all_weapons", "get_weapons_etag", "create_weapon", "get_weapon", "delete_weapon",
+    "create_battle", "get_battle", "get_battle_etag", "delete_battle", "send_battle_action",
+    "send_battle_actions", "auto_battle", "get_battle_events",
+    "create_log", "get_log", "delete_log",
+    "create_request", "get_request", "delete_request", "respond_to_request",
+    "get_matchup_stats", "get_round_stats", "get_character_stats", "get_top_characters", "get_weapon_stats",
+])
+metrics.registry += [
+    metrics.Gauge("ai_weapon_cache_hits_total", "Weapon lookups answered by the cache.",
+                  lambda: weapon_cache.hits, kind="counter"),
+    metrics.Gauge("ai_weapon_cache_misses_total", "Weapon lookups that went to the database.",
+                  lambda: weapon_cache.misses, kind="counter"),
+]
 
 #############
 #  HELPERS  #
 #############
 
-def success_response(data, code=200):
-    return json.dumps({"success": True, "data": data}), code
+JSON_HEADERS = {"Content-Type": serializer.MIMETYPE}
+
+def success_response(data, code=200, **fields):
+    return serializer.dumps({"success": True, "data": data, **fields}), code, JSON_HEADERS
 
 def failure_response(message, code=404):
-    return json.dumps({"success": False, "error": message}), code
+    return serializer.dumps({"success": False, "error": message}), code, JSON_HEADERS
 
 exhaustive_check = lambda body, fields: any([body.get(x[0], None) == None for x in fields])
 type_check = lambda body, fields: any([type(body.get(x[0], None)) != x[1] for x in fields])
@@ -32,6 +60,68 @@ def is_valid(body, fields):
 
 specific_check = lambda value, options: any([value == option for option in options])
 
+def batch_item_response(data, code):
+    if code >= 400:
+        return {"success": False, "error": data, "code": code}
+    return {"success": True, "data": data, "code": code}
+
+def page_check(args):
+    try:
+        after = int(args.get("after", 0))
+        limit = int(args.get("limit", dao.DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return None
+    if after < 0 or limit < 1 or limit > dao.MAX_PAGE_SIZE:
+        return None
+    return after, limit
+
+def ndjson_response(chunks):
+    lines = (b"".join(serializer.dumps(item) + b"\n" for item in chunk) for chunk in chunks)
+    return Response(stream_with_context(lines), mimetype="application/x-ndjson")
+
+# Tags are read before the body they're sent with, so a tag can be older
+# than its body but never newer, which only costs a client one extra refresh
+def is_fresh(etag):
+    return etag is not None and etag in request.if_none_match
+
+def not_modified(etag):
+    return "", 304, {"ETag": quote_etag(etag)}
+
+def tagged_response(response, etag):
+    data, code, headers = response
+    return data, code, (headers if etag is None else dict(headers, ETag=quote_etag(etag)))
+
+# Logs written by another worker process never reach this one's broadcaster,
+# so an idle stream checks the database for them this often
+EVENT_POLL_SECONDS = 1
+
+# Taken by each open stream, see Config.MAX_EVENT_STREAMS
+event_stream_slots = threading.BoundedSemaphore(app.config["MAX_EVENT_STREAMS"])
+
+def battle_event_stream(bid, after, watcher, events):
+    last_lid = after
+    try:
+        while True:
+            for lid, frame in events.frames:
+                # Anything already sent from the backlog or a poll is skipped
+                if lid > last_lid:
+                    last_lid = lid
+                    yield frame
+            if events.done:
+                yield broadcast.DONE_FRAME
+                return
+            try:
+                events = watcher.get(timeout=EVENT_POLL_SECONDS)
+            except queue.Empty:
+                with app.app_context():
+                    events = dao.get_battle_events(bid, last_lid)
+                if events is None:
+                    return # battle was deleted
+                if not events.frames:
+                    yield broadcast.KEEPALIVE_FRAME
+    finally:
+        broadcaster.unsubscribe(bid, watcher)
+
 ###########
 #  PATHS  #
 ###########
@@ -44,11 +134,21 @@ SPECIFIC_CHARACTER_PATH = CHARACTER_PATH + "<int:cid>/"
 WEAPON_PATH = API_PATH + "weapons/"
 SPECIFIC_WEAPON_PATH = WEAPON_PATH + "<int:wid>/"
 BATTLE_PATH = API_PATH + "battles/"
+BATTLE_ACTIONS_PATH = BATTLE_PATH + "actions/"
 SPECIFIC_BATTLE_PATH = BATTLE_PATH + "<int:bid>/"
+AUTO_BATTLE_PATH = SPECIFIC_BATTLE_PATH + "auto/"
+BATTLE_EVENTS_PATH = SPECIFIC_BATTLE_PATH + "events/"
 LOG_PATH = SPECIFIC_BATTLE_PATH + "logs/"
 SPECIFIC_LOG_PATH = LOG_PATH + "<int:lid>/"
 REQUEST_PATH = API_PATH + "requests/"
 SPECIFIC_REQUEST_PATH = REQUEST_PATH + "<int:rid>/"
+ANALYTICS_PATH = API_PATH + "analytics/"
+MATCHUP_ANALYTICS_PATH = ANALYTICS_PATH + "matchups/"
+ROUND_ANALYTICS_PATH = ANALYTICS_PATH + "rounds/"
+CHARACTER_ANALYTICS_PATH = ANALYTICS_PATH + "characters/"
+SPECIFIC_CHARACTER_ANALYTICS_PATH = CHARACTER_ANALYTICS_PATH + "<int:cid>/"
+WEAPON_ANALYTICS_PATH = ANALYTICS_PATH + "weapons/"
+METRICS_PATH = API_PATH + "_metrics"
 
 #################
 #  USER ROUTES  #
@@ -70,11 +170,19 @@ def welcome_page():
     )
 @app.route(USER_PATH)
 def get_all_users():
-    return success_response(dao.get_all_users())
+    page = page_check(request.args)
+    if page is None:
+        return failure_response("Provide a proper query of the form "
+                                f"?after=number&limit=1..{dao.MAX_PAGE_SIZE}", 400)
+    after, limit = page
+    if request.args.get("stream") == "true":
+        return ndjson_response(dao.stream_all_users(after, limit))
+    users, next_after = dao.get_all_users(after, limit)
+    return success_response(users, next_after=next_after)
 
 @app.route(USER_PATH, methods=["POST"])
 def create_user():
-    body = json.loads(request.data)
+    body = serializer.loads(request.data)
     if not is_valid(body, [("username", str)]):
         return failure_response("Provide a proper request of the form {username: string}", 400)
     user = dao.create_user(
@@ -84,10 +192,13 @@ def create_user():
 
 @app.route(SPECIFIC_USER_PATH)
 def get_user(uid):
+    etag = dao.get_user_etag(uid)
+    if is_fresh(etag):
+        return not_modified(etag)
     user = dao.get_user(uid)
     if user is None:
         return failure_response("This user does not exist!")
-    return success_response(user)
+    return tagged_response(success_response(user), etag)
 
 @app.route(SPECIFIC_USER_PATH, methods=["DELETE"])
 def delete_user(uid):
@@ -98,7 +209,7 @@ def delete_user(uid):
 
 @app.route(SPECIFIC_USER_PATH, methods=["POST"])
 def end_friendship(uid):
-    body = json.loads(request.data)
+    body = serializer.loads(request.data)
     if not is_valid(body, [("ex_friend_id", int)]):
         return failure_response("Provide a proper request of the form {ex_friend_id: number}", 400)
     user, code = dao.end_friendship(
@@ -116,7 +227,7 @@ def end_friendship(uid):
 
 @app.route(CHARACTER_PATH, methods=["POST"])
 def create_character(uid):
-    body = json.loads(request.data)
+    body = serializer.loads(request.data)
     if not is_valid(body, [("name", str)]):
         return failure_response("Provide a proper request of the form "
                                 "{name: string}", 400)
@@ -144,7 +255,7 @@ def delete_character(uid, cid):
 
 @app.route(SPECIFIC_CHARACTER_PATH, methods=["POST"])
 def prepare_weapon(uid, cid):
-    body = json.loads(request.data)
+    body = serializer.loads(request.data)
     if not is_valid(body, [("weapon_id", int)]):
         return failure_response("Provide a proper request of the form "
                                 "{weapon_id: number}", 400)
@@ -163,11 +274,14 @@ def prepare_weapon(uid, cid):
 
 @app.route(WEAPON_PATH)
 def get_all_weapons():
-    return success_response(dao.get_all_weapons())
+    etag = dao.get_weapons_etag()
+    if is_fresh(etag):
+        return not_modified(etag)
+    return tagged_response(success_response(dao.get_all_weapons()), etag)
 
 @app.route(WEAPON_PATH, methods=["POST"])
 def create_weapon():
-    body = json.loads(request.data)
+    body = serializer.loads(request.data)
     if not is_valid(body, [("name", str), ("atk", int)]):
         return failure_response("Provide a proper request of the form "
                                 "{name: string, atk: number}", 400)
@@ -197,7 +311,7 @@ def delete_weapon(wid):
 
 @app.route(BATTLE_PATH, methods=["POST"])
 def create_battle():
-    body = json.loads(request.data)
+    body = serializer.loads(request.data)
     if not (is_valid(body, [("challenger_id", int), ("opponent_id", int)]) or
             is_valid(body, [("challenger_id", int)]) and 
             body.get("opponent_id") is None):
@@ -213,10 +327,13 @@ def create_battle():
 
 @app.route(SPECIFIC_BATTLE_PATH)
 def get_battle(bid):
+    etag = dao.get_battle_etag(bid)
+    if is_fresh(etag):
+        return not_modified(etag)
     battle = dao.get_battle(bid)
     if battle is None:
         return failure_response("This battle does not exist!")
-    return success_response(battle)
+    return tagged_response(success_response(battle), etag)
 
 @app.route(SPECIFIC_BATTLE_PATH, methods=["DELETE"])
 def delete_battle(bid):
@@ -227,7 +344,7 @@ def delete_battle(bid):
 
 @app.route(SPECIFIC_BATTLE_PATH, methods=["POST"])
 def send_battle_action(bid):
-    body = json.loads(request.data)
+    body = serializer.loads(request.data)
     if not is_valid(body, [("actor_id", int), ("action", str)]):
         return failure_response("Provide a proper request of the form "
                                 "{actor_id: number, action: string}", 400)
@@ -242,13 +359,79 @@ def send_battle_action(bid):
         return failure_response(response, code)
     return success_response(response, 202)
 
+@app.route(BATTLE_ACTIONS_PATH, methods=["POST"])
+def send_battle_actions():
+    body = serializer.loads(request.data)
+    entries = body.get("actions")
+    if type(entries) != list or not 0 < len(entries) <= dao.MAX_BATCH_ACTIONS:
+        return failure_response("Provide a proper request of the form {actions: [{bid: number, "
+                                f"actor_id: number, action: string}}]}} with 1..{dao.MAX_BATCH_ACTIONS} "
+                                "actions", 400)
+
+    # Malformed entries are answered individually so the rest of the batch still runs
+    results = [None] * len(entries)
+    valid = []
+    for i, entry in enumerate(entries):
+        if type(entry) != dict or not is_valid(entry, [("bid", int), ("actor_id", int), ("action", str)]):
+            results[i] = ("Provide a proper action of the form "
+                          "{bid: number, actor_id: number, action: string}", 400)
+        elif not specific_check(entry.get("action"), ["Attack", "Defend", "Counter"]):
+            results[i] = ("Field action must be Attack, Defend, or Counter", 400)
+        else:
+            valid.append(i)
+
+    for i, result in zip(valid, dao.send_battle_actions([entries[i] for i in valid])):
+        results[i] = result
+    return success_response([batch_item_response(data, code) for data, code in results])
+
+@app.route(AUTO_BATTLE_PATH, methods=["POST"])
+def auto_battle(bid):
+    body = serializer.loads(request.data)
+    if not is_valid(body, [("actor_id", int), ("strategy", str)]):
+        return failure_response("Provide a proper request of the form "
+                                "{actor_id: number, strategy: string}", 400)
+    if not specific_check(body.get("strategy"), dao.AUTO_STRATEGIES):
+        return failure_response("Field strategy must be Attack, Defend, Counter, or random", 400)
+    battle, code = dao.auto_battle(
+        actor_id=body.get("actor_id"),
+        strategy=body.get("strategy"),
+        bid=bid
+    )
+    if code != 200:
+        return failure_response(battle, code)
+    return success_response(battle)
+
+@app.route(BATTLE_EVENTS_PATH)
+def get_battle_events(bid):
+    try:
+        after = int(request.headers.get("Last-Event-ID", request.args.get("after", 0)))
+    except ValueError:
+        return failure_response("Provide a proper query of the form ?after=number", 400)
+
+    if not event_stream_slots.acquire(blocking=False):
+        data, code, headers = failure_response("Too many battles are being watched, try again later", 503)
+        return data, code, dict(headers, **{"Retry-After": str(EVENT_POLL_SECONDS * 5)})
+
+    # Subscribing before reading the backlog means no log can fall between the two
+    watcher = broadcaster.subscribe(bid)
+    events = dao.get_battle_events(bid, after)
+    if events is None:
+        broadcaster.unsubscribe(bid, watcher)
+        event_stream_slots.release()
+        return failure_response("This battle does not exist!")
+    response = Response(battle_event_stream(bid, after, watcher, events), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # Called however the stream ends, even if it's dropped before it starts
+    response.call_on_close(event_stream_slots.release)
+    return response
+
 ################
 #  LOG ROUTES  #
 ################
 
 @app.route(LOG_PATH, methods=["POST"])
 def create_log(bid):
-    body = json.loads(request.data)
+    body = serializer.loads(request.data)
     if not is_valid(body, [("timestamp", int), ("challenger_hp", int),
                            ("opponent_hp", int), ("action", str)]):
         return failure_response("Provide a proper request of the form {timestamp: number, "
@@ -284,7 +467,7 @@ def delete_log(bid, lid):
 
 @app.route(REQUEST_PATH, methods=["POST"])
 def create_request():
-    body = json.loads(request.data)
+    body = serializer.loads(request.data)
     if not is_valid(body, [("kind", str), ("sender_id", int), ("receiver_id", int)]):
         return failure_response("Provide a proper request of the form {kind: string, "
                                 "sender_id: number, receiver_id: number}", 400)
@@ -315,7 +498,7 @@ def delete_request(rid):
 
 @app.route(SPECIFIC_REQUEST_PATH, methods=["POST"])
 def respond_to_request(rid):
-    body = json.loads(request.data)
+    body = serializer.loads(request.data)
     if not is_valid(body, [("receiver_id", int), ("accepted", bool)]):
         return failure_response("Provide a proper request of the form "
                                 "{receiver_id: number, accepted: boolean}", 400)
@@ -328,5 +511,69 @@ def respond_to_request(rid):
         return failure_response(data, code)
     return success_response(data)
 
+######################
+#  ANALYTICS ROUTES  #
+######################
+
+@app.route(MATCHUP_ANALYTICS_PATH)
+def get_matchup_stats():
+    return success_response(dao.get_matchup_stats())
+
+@app.route(ROUND_ANALYTICS_PATH)
+def get_round_stats():
+    return success_response(dao.get_round_stats())
+
+@app.route(CHARACTER_ANALYTICS_PATH)
+def get_top_characters():
+    page = page_check(request.args)
+    if page is None:
+        return failure_response(f"Provide a proper query of the form ?limit=1..{dao.MAX_PAGE_SIZE}", 400)
+    _, limit = page
+    return success_response(dao.get_top_characters(limit))
+
+@app.route(SPECIFIC_CHARACTER_ANALYTICS_PATH)
+def get_character_stats(cid):
+    stats, code = dao.get_character_stats(cid)
+    if code != 200:
+        return failure_response(stats, code)
+    return success_response(stats)
+
+@app.route(WEAPON_ANALYTICS_PATH)
+def get_weapon_stats():
+    return success_response(dao.get_weapon_stats())
+
+####################
+#  METRICS ROUTES  #
+####################
+
+@app.route(METRICS_PATH)
+def get_metrics():
+    if not metrics.is_allowed(app.config["METRICS_ALLOWED_ADDRESSES"]):
+        return failure_response("Metrics are only served to allowed addresses!", 403)
+    return Response(metrics.render(), mimetype=metrics.MIMETYPE)
+
+##############
+#  COMMANDS  #
+##############
+
+@app.cli.command("check-active-battles")
+@click.option("--repair", is_flag=True, help="Rewrite every pointer that disagrees with the battles.")
+def check_active_battles(repair):
+    mismatches = dao.check_active_battles(repair)
+    for mismatch in mismatches:
+        click.echo(json.dumps(mismatch))
+    click.echo(f"{len(mismatches)} characters {'repaired' if repair else 'out of sync'}")
+
+@app.cli.command("rebuild-analytics")
+def rebuild_analytics():
+    dao.rebuild_analytics(db.session.connection())
+    db.session.commit()
+    click.echo("Analytics recounted from every finished battle")
+
+@app.cli.command("archive-battles")
+def archive_battles():
+    archived, kept = dao.archive_battles()
+    click.echo(f"{archived} finished battles archived, {kept} kept their logs")
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,74 @@
+import argparse
+import time
+import numpy as np
+import combat
+import serializer
+
+#############
+#  HELPERS  #
+#############
+
+def best_of(repeat, run):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def report(name, size, seconds):
+    print(f"{name:<32} {size:>10} items {seconds * 1e3:>10.2f} ms {seconds / size * 1e9:>10.1f} ns/item")
+
+################
+#  BENCHMARKS  #
+################
+
+def bench_combat(size, repeat):
+    rng = np.random.default_rng(0)
+    c_hp, o_hp = rng.integers(1, 100, size), rng.integers(1, 100, size)
+    c_atk, o_atk = rng.integers(1, 20, size), rng.integers(1, 20, size)
+    c_act, o_act = rng.integers(0, 3, size), rng.integers(0, 3, size)
+    rows = [((int(c_hp[i]), combat.ACTIONS[c_act[i]], int(c_atk[i])),
+             (int(o_hp[i]), combat.ACTIONS[o_act[i]], int(o_atk[i]))) for i in range(size)]
+
+    report("combat.resolve", size,
+           best_of(repeat, lambda: [combat.resolve(c_info, o_info) for c_info, o_info in rows]))
+    report("combat.resolve_batch", size,
+           best_of(repeat, lambda: combat.resolve_batch(c_hp, c_act, c_atk, o_hp, o_act, o_atk)))
+
+# Shaped like User.serialize() and Battle.serialize() output
+def user_list_payload(size):
+    character = lambda i: {"id": i, "name": f"Character {i}", "mhp": 30, "atk": 8,
+                           "equipped": {"id": i % 10, "name": "Rubber Duck", "atk": 1337}}
+    friend = lambda i: {"id": i, "username": f"user{i}", "characters": [character(i * 3 + j) for j in range(3)]}
+    return {"success": True, "data": [dict(friend(i), friends=[friend((i + j) % size) for j in range(5)])
+                                      for i in range(size)]}
+
+def battle_log_payload(size):
+    action = ("Challenger Chalos used Counter and dealt 4 damage! "
+              "Opponent Solach used Attack and dealt 0 damage!")
+    logs = [{"id": i, "timestamp": 1600000000000000000 + i, "challenger_hp": 10, "opponent_hp": 6,
+             "action": action} for i in range(size)]
+    return {"success": True, "data": {"id": 1, "challenger_id": 1, "opponent_id": 2, "logs": logs, "done": True}}
+
+def bench_json(size, repeat):
+    payloads = {"user list": user_list_payload(max(size // 100, 1)), "battle logs": battle_log_payload(size)}
+    for backend, (dumps, loads) in sorted(serializer.BACKENDS.items()):
+        for name, payload in payloads.items():
+            encoded = dumps(payload)
+            items = len(payload["data"]) if name == "user list" else len(payload["data"]["logs"])
+            report(f"{backend} dumps {name}", items, best_of(repeat, lambda: dumps(payload)))
+            report(f"{backend} loads {name}", items, best_of(repeat, lambda: loads(encoded)))
+
+BENCHMARKS = {
+    "combat": bench_combat,
+    "json": bench_json,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the game's hot paths")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--size", type=int, default=100000, help="items per run")
+    parser.add_argument("--repeat", type=int, default=5, help="runs to take the best of")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args.size, args.repeat)
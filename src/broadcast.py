@@ -0,0 +1,50 @@
+import queue
+import threading
+from collections import namedtuple
+import serializer
+
+# Ready-to-send server-sent event frames for a run of logs, keyed by log id
+BattleEvents = namedtuple("BattleEvents", ["frames", "done"])
+
+DONE_FRAME = b"event: done\ndata: {}\n\n"
+KEEPALIVE_FRAME = b": keepalive\n\n"
+
+def encode_events(serialized_logs, done):
+  return BattleEvents(
+    [(log["id"], b"id: %d\nevent: log\ndata: %b\n\n" % (log["id"], serializer.dumps(log)))
+     for log in serialized_logs],
+    done
+  )
+
+class Broadcaster:
+  # Hands every published batch of events to each watcher of a battle. The
+  # events are encoded once by the publisher and shared, so a battle with
+  # many watchers costs no more to publish than one with a single watcher.
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.watchers = {}
+
+  def subscribe(self, bid):
+    watcher = queue.Queue()
+    with self.lock:
+      self.watchers.setdefault(bid, set()).add(watcher)
+    return watcher
+
+  def unsubscribe(self, bid, watcher):
+    with self.lock:
+      watchers = self.watchers.get(bid, set())
+      watchers.discard(watcher)
+      if not watchers:
+        self.watchers.pop(bid, None)
+
+  def is_watched(self, bid):
+    return bid in self.watchers
+
+  def publish(self, bid, events):
+    with self.lock:
+      watchers = list(self.watchers.get(bid, ()))
+    for watcher in watchers:
+      watcher.put(events)
+
+broadcaster = Broadcaster()
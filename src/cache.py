@@ -0,0 +1,100 @@
+import threading
+from flask import g
+
+# Stored for ids known not to exist, so they aren't looked up again either
+MISSING = object()
+
+class VersionedCache:
+  # Holds values read at one version of a catalog. Other worker processes
+  # change the catalog without telling this one, so the version is checked
+  # against the database once per request and everything is dropped when it
+  # has moved.
+
+  def __init__(self, name, load_version):
+    self.name = name
+    self.load_version = load_version
+    self.lock = threading.Lock()
+    self.version = None
+    self.items = {}
+    self.snapshot = None
+    self.hits = 0
+    self.misses = 0
+
+  def check(self):
+    # Returns the version this request is working at
+    checked = g.setdefault("checked_caches", {})
+    if self.name not in checked:
+      checked[self.name] = self.load_version()
+      self.sync(checked[self.name])
+    return checked[self.name]
+
+  def sync(self, version):
+    with self.lock:
+      if version != self.version:
+        self.version = version
+        self.items = {}
+        self.snapshot = None
+
+  def invalidate(self):
+    # For writes made by this process, so the rest of the request sees them too
+    with self.lock:
+      self.version = None
+      self.items = {}
+      self.snapshot = None
+    g.setdefault("checked_caches", {}).pop(self.name, None)
+
+  def get(self, key, load):
+    self.check()
+    # Held onto before loading so that, if another thread moves the version
+    # meanwhile, what was read goes into the dropped dict and not the new one
+    items = self.items
+    value = items.get(key)
+    if value is None:
+      self.count(hit=False)
+      value = load(key)
+      items[key] = MISSING if value is None else value
+      return value
+
+    self.count(hit=True)
+    return None if value is MISSING else value
+
+  def get_many(self, keys, load_many):
+    # Loads every key not held yet in one call, so listing many things that
+    # each point into the catalog costs one query however many keys are new.
+    # load_many returns a dict of the keys that exist.
+    self.check()
+    items = self.items
+    keys = set(keys)
+    missing = {key for key in keys if key not in items}
+    if missing:
+      loaded = load_many(missing)
+      for key in missing:
+        items[key] = loaded.get(key, MISSING)
+    self.count(hit=True, times=len(keys) - len(missing))
+    self.count(hit=False, times=len(missing))
+    return {key: items[key] for key in keys if items[key] is not MISSING}
+
+  def get_snapshot(self, load):
+    # The whole catalog, already serialized
+    self.check()
+    version, snapshot = self.version, self.snapshot
+    if snapshot is None:
+      self.count(hit=False)
+      snapshot = load()
+      with self.lock:
+        if self.version == version:
+          self.snapshot = snapshot
+      return snapshot
+
+    self.count(hit=True)
+    return snapshot
+
+  def count(self, hit, times=1):
+    with self.lock:
+      if hit:
+        self.hits += times
+      else:
+        self.misses += times
+
+  def stats(self):
+    return {"version": self.version, "size": len(self.items), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,60 @@
+import numpy as np
+
+# Every character starts with these stats and the winner of each battle grows by the increments
+STARTING_MHP = 10
+STARTING_ATK = 2
+MHP_INCREMENT = 4
+ATK_INCREMENT = 2
+
+ACTIONS = ["Attack", "Defend", "Counter"]
+ACTION_CODES = {action: code for code, action in enumerate(ACTIONS)}
+
+# How much of their attack each battler lands, indexed by
+# [challenger action][opponent action] in ACTIONS order
+CHALLENGER_DEALT = (
+  (1, 0.5, 0), # Attack against Attack, Defend, Counter
+  (0, 0, 1),   # Defend
+  (2, 0, 0),   # Counter
+)
+OPPONENT_DEALT = (
+  (1, 0, 2),
+  (0.5, 0, 0),
+  (0, 1, 0),
+)
+
+CHALLENGER_DEALT_TABLE = np.array(CHALLENGER_DEALT, dtype=np.float64)
+OPPONENT_DEALT_TABLE = np.array(OPPONENT_DEALT, dtype=np.float64)
+
+def resolve(c_info, o_info):
+  c_hp, c_act, c_atk = c_info
+  o_hp, o_act, o_atk = o_info
+  c_share = CHALLENGER_DEALT[ACTION_CODES[c_act]][ACTION_CODES[o_act]]
+  o_share = OPPONENT_DEALT[ACTION_CODES[c_act]][ACTION_CODES[o_act]]
+  if not c_share and not o_share:
+    return (c_hp, o_hp), 0, 0
+
+  c_dealt = dealt(c_share, c_atk)
+  o_dealt = dealt(o_share, o_atk)
+  return nonnegate(c_hp - o_dealt, o_hp - c_dealt), c_dealt, o_dealt
+
+def resolve_batch(c_hp, c_act, c_atk, o_hp, o_act, o_atk):
+  # Same rules as resolve() over whole arrays, with actions given as ACTION_CODES
+  c_dealt = CHALLENGER_DEALT_TABLE[c_act, o_act] * c_atk
+  o_dealt = OPPONENT_DEALT_TABLE[c_act, o_act] * o_atk
+  return np.maximum(c_hp - o_dealt, 0), np.maximum(o_hp - c_dealt, 0), c_dealt, o_dealt
+
+# Keeps whole numbers as ints so logs read "dealt 4 damage", never "dealt 4.0"
+dealt = lambda share, atk: 0 if share == 0 else share * atk
+
+nonnegate = lambda c_hp, o_hp: (0 if c_hp < 0 else c_hp, 0 if o_hp < 0 else o_hp)
+
+def replay(c_hp, o_hp, c_atk, o_atk, actions):
+  # Plays a battle again from its starting HP and its rounds' action codes,
+  # two digits a round, yielding each round's actions, HP left and damage
+  for start in range(0, len(actions), 2):
+    c_act, o_act = ACTIONS[int(actions[start])], ACTIONS[int(actions[start + 1])]
+    (c_hp, o_hp), c_dealt, o_dealt = resolve((c_hp, c_act, c_atk), (o_hp, o_act, o_atk))
+    yield c_act, o_act, whole(c_hp), whole(o_hp), c_dealt, o_dealt
+
+# HP is stored in integer columns, which keep halves but drop a whole float's ".0"
+whole = lambda hp: int(hp) if hp == int(hp) else hp
@@ -0,0 +1,55 @@
+import os
+from sqlalchemy.pool import StaticPool
+
+env_int = lambda name, default: int(os.environ.get(name, default))
+
+# Applied to every new SQLite connection. WAL lets readers carry on while a
+# battle round is being written, and NORMAL syncs are safe under WAL
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024, # negative means KiB rather than pages
+    "busy_timeout": 5000,
+}
+
+def database_uri():
+    uri = os.environ.get("DATABASE_URL", "sqlite:///ai.db")
+    # Hosted PostgreSQL often hands out the scheme SQLAlchemy no longer accepts
+    return "postgresql://" + uri[len("postgres://"):] if uri.startswith("postgres://") else uri
+
+class Config:
+    SQLALCHEMY_DATABASE_URI = database_uri()
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    DB_POOL_SIZE = env_int("DB_POOL_SIZE", 10)
+    DB_MAX_OVERFLOW = env_int("DB_MAX_OVERFLOW", 20)
+    DB_POOL_TIMEOUT = env_int("DB_POOL_TIMEOUT", 30)
+    DB_POOL_RECYCLE = env_int("DB_POOL_RECYCLE", 1800)
+    SQLITE_PRAGMAS = {name: os.environ.get("SQLITE_" + name.upper(), value)
+                      for name, value in SQLITE_PRAGMAS.items()}
+    # Who may read /api/_metrics, comma separated. Behind a proxy this is the
+    # proxy's address, so it should only let the scraper's requests through.
+    METRICS_ALLOWED_ADDRESSES = os.environ.get("METRICS_ALLOWED_ADDRESSES", "127.0.0.1,::1").split(",")
+    # Every battle watcher holds one of a worker's threads for as long as it's
+    # connected, so only this many may stream at once per worker process. The
+    # rest get a 503. Keep it below the threads start_server.sh gives a worker.
+    MAX_EVENT_STREAMS = env_int("MAX_EVENT_STREAMS", 4)
+
+def engine_options(config):
+    uri = config["SQLALCHEMY_DATABASE_URI"]
+    # An in-memory database only lives as long as its one connection, so
+    # every thread has to share that connection
+    if uri in ("sqlite://", "sqlite:///:memory:"):
+        return {"poolclass": StaticPool, "connect_args": {"check_same_thread": False}}
+    # SQLAlchemy picks the right pool for SQLite itself, and some of its
+    # pools reject sizing arguments, so those are only for server databases
+    if uri.startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+        "pool_pre_ping": True,
+    }
@@ -1,14 +1,61 @@
-from db import db, User, Character, Weapon, Battle, Log, Request, Action
+from db import db, friends_table, User, Character, Weapon, Catalog, Battle, Log, Request, Action
+from db import MatchupStat, RoundStat, ROUND_BUCKETS, OUTCOMES, FLIPPED_OUTCOMES
+from db import WEAPON_CATALOG, weapon_cache, load_weapon, load_weapons, pack_archive
+from db import LOG_START, LOG_ROUND, LOG_WIN, LOG_DRAW, LOG_CUSTOM
+from sqlalchemy import and_, bindparam, func
+from sqlalchemy.orm import Query, selectinload
+from broadcast import broadcaster
+import broadcast
+import combat
+import bisect
 import time
 import random
-from functools import reduce
 
 ###########
 #  USERS  #
 ###########
 
-def get_all_users():
-  return [user.serialize() for user in User.query.all()]
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def get_all_users(after=0, limit=DEFAULT_PAGE_SIZE):
+  # A full page may have more after it, so it comes with the cursor to ask
+  # for them. A short one is the last.
+  users = get_user_page(after, limit)
+  next_after = users[-1].id if len(users) == limit else None
+  return [user.serialize() for user in users], next_after
+
+def stream_all_users(after=0, chunk_size=DEFAULT_PAGE_SIZE):
+  # Walks the user table in primary key order one page at a time, dropping
+  # each page from the session before the next so memory stays bounded
+  while True:
+    users = get_user_page(after, chunk_size)
+    if not users:
+      return
+    yield [user.serialize() for user in users]
+    after = users[-1].id
+    db.session.expunge_all()
+
+def get_user_page(after, limit):
+  return cache_weapons(query_users().filter(User.id > after).order_by(User.id).limit(limit).all())
+
+def query_users():
+  # Loads characters and friends up front so that serializing any number of
+  # users costs a fixed number of queries, equipped weapons come from the
+  # cache once cache_weapons() has filled it
+  return User.query.options(
+    selectinload(User.characters),
+    selectinload(User.friends).selectinload(User.characters)
+  )
+
+def cache_weapons(users):
+  # Every weapon the users and their friends have equipped, loaded into the
+  # cache in one query instead of one for each weapon it was missing
+  characters = [character for user in users for owner in [user] + user.friends for character in owner.characters]
+  wids = {character.weapon_id for character in characters if character.weapon_id is not None}
+  if wids:
+    weapon_cache.get_many(wids, load_weapons)
+  return users
 
 def create_user(username):
   new_user = User(
@@ -26,15 +73,36 @@ def delete_user(uid):
   return validate_user_request(uid, delete=True)
 
 def validate_user_request(uid, delete):
-  user = User.query.filter_by(id=uid).first()
+  user = query_users().filter_by(id=uid).first()
   if user is None:
     return None
+  cache_weapons([user])
   
   if delete:
+    touch_users([uid])
     db.session.delete(user)
     db.session.commit()
   return user.serialize()
 
+def user_exists(uid):
+  return db.session.query(User.id).filter_by(id=uid).first() is not None
+
+def get_user_etag(uid):
+  # Equipped weapons show up in the user too, so the weapon list's version is part of the tag
+  versions = (db.session.query(User.version, Catalog.version)
+              .outerjoin(Catalog, Catalog.name == WEAPON_CATALOG)
+              .filter(User.id == uid).first())
+  if versions is None:
+    return None
+  user_version, catalog_version = versions
+  return f"{user_version}-{catalog_version or 0}"
+
+def touch_users(uids):
+  # A user shows their friends' characters, so everyone who friended them changes too
+  frienders = db.session.query(friends_table.c.friender_id).filter(friends_table.c.friendee_id.in_(uids))
+  User.query.filter(db.or_(User.id.in_(uids), User.id.in_(frienders))).update(
+    {User.version: User.version + 1}, synchronize_session=False)
+
 def end_friendship(uid, ex_friend_id):
   ending_user = User.query.filter_by(id=uid).first()
   if ending_user is None:
@@ -52,6 +120,7 @@ def end_friendship(uid, ex_friend_id):
 
   ending_user.friends.remove(ex_friend_user)
   ex_friend_user.friends.remove(ending_user)
+  touch_users([uid, ex_friend_id])
   db.session.commit()
   return ex_friend_user.serialize(), 200
 
@@ -60,7 +129,7 @@ def end_friendship(uid, ex_friend_id):
 ################
 
 def create_character(name, uid):
-  if get_user(uid) is None:
+  if not user_exists(uid):
     return None
 
   new_character = Character(
@@ -69,6 +138,7 @@ def create_character(name, uid):
   )
 
   db.session.add(new_character)
+  touch_users([uid])
   db.session.commit()
   return new_character.serialize()
 
@@ -79,47 +149,53 @@ def delete_character(uid, cid):
   return validate_character_request(uid, cid, delete=True)
 
 def prepare_weapon(uid, cid, wid):
-  serialized_character, code = validate_character_request(uid, cid, delete=False)
+  character, code = find_character(uid, cid)
   if code != 200:
-    return serialized_character, code # error message
+    return character, code # error message
 
-  weapon = get_weapon(wid)
-  if weapon is None:
+  if weapon_cache.get(wid, load_weapon) is None:
     return "This weapon does not exist!", 404
 
-  character, code = update_character_weapon(cid, wid)
+  character, code = update_character_weapon(character, wid)
   if code != 200:
     return character, code
   
   return character.serialize(), 200
   
 def validate_character_request(uid, cid, delete):
-  user = get_user(uid)
-  if user is None:
-    return "The provided user does not exist!", 404
-  
-  character = Character.query.filter_by(id=cid).first()
-  if character is None:
-    return "This character does not exist!", 404
-  
-  serialized_character = character.serialize()
-  if serialized_character not in user["characters"]:
-    return "This character does not belong to the provided user!", 403
+  character, code = find_character(uid, cid)
+  if code != 200:
+    return character, code # error message
 
+  serialized_character = character.serialize()
   if delete:
     db.session.delete(character)
+    touch_users([uid])
     db.session.commit()
     return serialized_character, 202
   return serialized_character, 200
 
-def update_character_weapon(cid, wid):
-  character = Character.query.filter_by(id=cid).first()
+def find_character(uid, cid):
+  character = Character.query.filter_by(id=cid, user_id=uid).first()
+  if character is not None:
+    return character, 200
+
+  # Only a miss needs the extra lookups to tell the caller what was wrong
+  if not user_exists(uid):
+    return "The provided user does not exist!", 404
+
+  if Character.query.filter_by(id=cid).first() is None:
+    return "This character does not exist!", 404
+  return "This character does not belong to the provided user!", 403
+
+def update_character_weapon(character, wid):
   if character.weapon_id == None:
     character.weapon_id = wid
   elif character.weapon_id == wid:
     character.weapon_id = None
   else:
     return "You don’t have this weapon equipped!", 403
+  touch_users([character.user_id])
   db.session.commit()
   return character, 200
 
@@ -132,7 +208,16 @@ def format_character(character, weapon):
 #############
 
 def get_all_weapons():
-  return [weapon.serialize() for weapon in Weapon.query.all()]
+  return weapon_cache.get_snapshot(lambda: [weapon.serialize() for weapon in Weapon.query.all()])
+
+def get_weapons_etag():
+  return str(weapon_cache.check())
+
+def touch_catalog(name):
+  updated = Catalog.query.filter_by(name=name).update(
+    {Catalog.version: Catalog.version + 1}, synchronize_session=False)
+  if not updated:
+    db.session.add(Catalog(name=name))
 
 def create_weapon(name, atk):
   new_weapon = Weapon(
@@ -141,11 +226,13 @@ def create_weapon(name, atk):
   )
 
   db.session.add(new_weapon)
+  touch_catalog(WEAPON_CATALOG)
   db.session.commit()
+  weapon_cache.invalidate()
   return new_weapon.serialize()
 
 def get_weapon(wid):
-  return validate_weapon_request(wid, delete=False)
+  return weapon_cache.get(wid, load_weapon)
 
 def delete_weapon(wid):
   return validate_weapon_request(wid, delete=True)
@@ -157,7 +244,9 @@ def validate_weapon_request(wid, delete):
   
   if delete:
     db.session.delete(weapon)
+    touch_catalog(WEAPON_CATALOG)
     db.session.commit()
+    weapon_cache.invalidate()
   return weapon.serialize()
 
 #############
@@ -165,57 +254,114 @@ def validate_weapon_request(wid, delete):
 #############
 
 def create_battle(challenger_id, opponent_id):
+  battle, code = start_battle(challenger_id, opponent_id)
+  if code == 201:
+    db.session.commit()
+  return battle, code
+
+def start_battle(challenger_id, opponent_id):
   challenger = Character.query.filter_by(id=challenger_id).first()
   if challenger is None:
     return "The challenger character does not exist!", 404
 
-  opponent = Character.query.filter_by(id=opponent_id).first()
-  if opponent_id is not None and opponent is None:
-    return "The opponent character does not exist!", 404
+  opponent = None
+  if opponent_id is not None:
+    opponent = Character.query.filter_by(id=opponent_id).first()
+    if opponent is None:
+      return "The opponent character does not exist!", 404
   
   if opponent_id is not None and challenger.user_id == opponent.user_id:
     return "The challenger and opponent belong to the same user!", 403
     
-  if is_battling(challenger_id):
+  if is_battling(challenger):
     return "The challenger is already in a battle!", 403
 
-  if opponent_id is not None and is_battling(opponent_id):
+  if opponent_id is not None and is_battling(opponent):
     return "The opponent is already in a battle!", 403
 
+  # The AI mirrors the challenger's stats
+  mirror = challenger if opponent is None else opponent
   new_battle = Battle(
     challenger_id=challenger_id,
-    opponent_id=opponent_id
+    opponent_id=opponent_id,
+    challenger_hp=challenger.mhp,
+    opponent_hp=mirror.mhp,
+    challenger_atk=get_battler_atk(challenger),
+    opponent_atk=get_battler_atk(mirror),
+    challenger_name=challenger.name,
+    opponent_name=None if opponent is None else opponent.name,
+    seed=random.getrandbits(31)
   )
   db.session.add(new_battle)
-  db.session.commit()
+  db.session.flush()
 
-  add_battle_action(new_battle)
-  
-  starting_log = create_starter_log(challenger, opponent, new_battle.id)
-  return add_log(starting_log, new_battle.id), 201
+  if not claim_battler(challenger_id, new_battle.id):
+    db.session.rollback()
+    return "The challenger is already in a battle!", 403
 
-def is_battling(cid):
-  first_check = Battle.query.filter_by(challenger_id=cid, 
-                                      done=False).first()
-  second_check = Battle.query.filter_by(opponent_id=cid, 
-                                      done=False).first()
-  return (first_check is not None) or (second_check is not None)
+  if opponent_id is not None and not claim_battler(opponent_id, new_battle.id):
+    db.session.rollback()
+    return "The opponent is already in a battle!", 403
+
+  add_battle_action(new_battle)
+  starting_log = generate_starter_log(new_battle)
+  new_battle.logs.append(starting_log)
+  db.session.add(starting_log)
+  db.session.flush()
+  return new_battle.serialize(), 201
+
+def is_battling(character):
+  return character.active_battle_id is not None
+
+def claim_battler(cid, bid):
+  # Only matches while the character is free, so two battles racing for the
+  # same character can never both start
+  claimed = Character.query.filter_by(id=cid, active_battle_id=None).update(
+    {Character.active_battle_id: bid}, synchronize_session=False)
+  return claimed == 1
+
+def release_battlers(battle):
+  ids = [battler_id for battler_id in (battle.challenger_id, battle.opponent_id) if battler_id is not None]
+  Character.query.filter(Character.id.in_(ids), Character.active_battle_id == battle.id).update(
+    {Character.active_battle_id: None}, synchronize_session=False)
+
+def check_active_battles(repair):
+  # Rebuilds what every character's active battle should be from the battles
+  # still in progress and reports (or fixes) any pointer that disagrees
+  expected = {}
+  unfinished = db.session.query(Battle.id, Battle.challenger_id, Battle.opponent_id).filter_by(done=False)
+  for bid, challenger_id, opponent_id in unfinished.order_by(Battle.id):
+    expected[challenger_id] = bid
+    if opponent_id is not None:
+      expected[opponent_id] = bid
+
+  mismatches = []
+  for cid, active_battle_id in db.session.query(Character.id, Character.active_battle_id):
+    if expected.get(cid) != active_battle_id:
+      mismatches.append({"id": cid, "active_battle_id": active_battle_id, "expected": expected.get(cid)})
+
+  if repair:
+    for mismatch in mismatches:
+      Character.query.filter_by(id=mismatch["id"]).update(
+        {Character.active_battle_id: mismatch["expected"]}, synchronize_session=False)
+    db.session.commit()
+  return mismatches
 
 def add_battle_action(battle):
   battle_action = Action(
-    battle_id=battle.id
+    bid=battle.id
   )
   battle.action.append(battle_action)
 
   db.session.add(battle_action)
-  db.session.commit()
-  
-def add_log(log, bid):
-  battle = Battle.query.filter_by(id=bid).first()
-  battle.logs.insert(0, log)
 
-  db.session.commit()
-  return battle.serialize()
+def get_battle_etag(bid):
+  version = db.session.query(Battle.version).filter_by(id=bid).scalar()
+  return None if version is None else str(version)
+
+def touch_battle(battle):
+  # Left to the database so concurrent rounds can't both land on the same version
+  battle.version = Battle.version + 1
 
 def get_battle(bid):
   return validate_battle_request(bid, delete=False)
@@ -228,22 +374,82 @@ def validate_battle_request(bid, delete):
   if battle is None:
     return None
   
+  serialized_battle = battle.serialize()
   if delete:
+    release_battlers(battle)
     db.session.delete(battle)
     db.session.commit()
-  return battle.serialize()
+  return serialized_battle
 
 def send_battle_action(actor_id, action, bid):
-  battle = Battle.query.filter_by(id=bid).first()
+  battle, code = find_battle_actor(actor_id, bid)
+  if code != 200:
+    return battle, code # error message
+
+  actor_type = get_actor_type(battle, actor_id)
+  if battle.opponent_id == None:
+    new_logs = update_battle_action(battle, actor_type, action, isAI = True)
+  else:
+    new_logs = update_battle_action(battle, actor_type, action, isAI = False)
+  
+  # The whole round, logs and stat changes included, lands in this one commit
+  db.session.commit()
+  publish_logs(bid, new_logs)
+  return "Your action has been recorded", 202
+
+MAX_BATCH_ACTIONS = 500
+
+def send_battle_actions(entries):
+  if not entries:
+    return []
+
+  # Everything the batch touches is fetched up front with one query per table
+  bids = {entry["bid"] for entry in entries}
+  battles = {battle.id: battle for battle in
+             Battle.query.options(selectinload(Battle.action)).filter(Battle.id.in_(bids))}
+  battler_ids = {entry["actor_id"] for entry in entries}
+  for battle in battles.values():
+    battler_ids.update([battle.challenger_id, battle.opponent_id])
+  battler_ids.discard(None)
+  battlers = {c.id: c for c in Character.query.filter(Character.id.in_(battler_ids))}
+
+  results = []
+  new_logs = {}
+  for entry in entries:
+    battle, code = check_battle_actor(battles.get(entry["bid"]), entry["actor_id"],
+                                      entry["actor_id"] in battlers)
+    if code != 200:
+      results.append((battle, code))
+      continue
+
+    new_logs.setdefault(battle.id, []).extend(update_battle_action(
+      battle, get_actor_type(battle, entry["actor_id"]), entry["action"],
+      isAI=battle.opponent_id is None,
+      battlers=(battlers.get(battle.challenger_id), battlers.get(battle.opponent_id))))
+    results.append(("Your action has been recorded", 202))
+
+  # Every round the batch completes is saved together
+  db.session.commit()
+  for bid, logs in new_logs.items():
+    publish_logs(bid, logs)
+  return results
+
+def find_battle_actor(actor_id, bid):
+  battle = Battle.query.options(selectinload(Battle.action)).filter_by(id=bid).first()
   if battle is None:
     return "The provided battle does not exist!", 404
   
   actor = Character.query.filter_by(id=actor_id).first()
-  if actor is None:
+  return check_battle_actor(battle, actor_id, actor is not None)
+
+def check_battle_actor(battle, actor_id, actor_exists):
+  if battle is None:
+    return "The provided battle does not exist!", 404
+
+  if not actor_exists:
     return "This character does not exist!", 404
 
-  actor_type = "challenger" if battle.challenger_id == actor_id else (
-               "opponent" if battle.opponent_id == actor_id else None)
+  actor_type = get_actor_type(battle, actor_id)
   if actor_type is None:
     return "This character does not belong to the provided battle!", 403
 
@@ -252,16 +458,13 @@ def send_battle_action(actor_id, action, bid):
 
   if get_actor_response(battle, actor_type) is not None:
     return "This character has already sent an action!", 403
+  return battle, 200
 
-  if battle.opponent_id == None:
-    update_battle_action(battle, actor_type, action, isAI = True)
-  else:
-    update_battle_action(battle, actor_type, action, isAI = False)
-  
-  db.session.commit()
-  return "Your action has been recorded", 202
+def get_actor_type(battle, actor_id):
+  return "challenger" if battle.challenger_id == actor_id else (
+         "opponent" if battle.opponent_id == actor_id else None)
 
-def update_battle_action(battle, actor_type, action, isAI):
+def update_battle_action(battle, actor_type, action, isAI, battlers=None):
 
   # Update action
   if actor_type == "challenger":
@@ -272,161 +475,218 @@ def update_battle_action(battle, actor_type, action, isAI):
   challenger_action = get_actor_response(battle, "challenger")
   opponent_action = get_actor_response(battle, "opponent")
   if isAI:
-    opponent_action = ["Attack", "Defend", "Counter"][random.randint(0,2)]
+    opponent_action = ai_action(round_rng(battle.seed, battle.round))
 
   # An action has been fulfilled
   if challenger_action is not None and opponent_action is not None:
-    # Calculate new battler health after damage
-    recent_log = reduce(lambda x, y: x if x.id > y.id else y, battle.logs)
+    new_logs = resolve_round(battle, challenger_action, opponent_action, battlers)
+    db.session.add_all(new_logs)
 
-    challenger_atk = (get_battler_stat(battle.challenger_id, "atk") + 
-                      get_battler_weapon_stat(battle.challenger_id))
-    opponent_atk = challenger_atk
-    if not isAI:
-      opponent_atk = (get_battler_stat(battle.opponent_id, "atk") + 
-                      get_battler_weapon_stat(battle.opponent_id))
-
-    challenger_info = (recent_log.challenger_hp, challenger_action, challenger_atk)
-    opponent_info = (recent_log.opponent_hp, opponent_action, opponent_atk)
+    # Prepare Action for next round
+    battle.action[0].challenger_action = None
+    battle.action[0].opponent_action = None
+    if battle.done:
+      record_battle_stats(battle)
+    return new_logs
+
+  # Still waiting on the other battler, nothing new to log
+  return []
+
+def resolve_round(battle, challenger_action, opponent_action, battlers=None):
+  # Plays one round on the in-memory battle and returns its logs, unsaved.
+  # The battlers are only needed, and only loaded, once the battle ends.
+
+  # Calculate new battler health after damage
+  challenger_info = (battle.challenger_hp, challenger_action, battle.challenger_atk)
+  opponent_info = (battle.opponent_hp, opponent_action, battle.opponent_atk)
+
+  (updated_c_hp, updated_o_hp), c_atk, o_atk = calculate_hp_and_atk(challenger_info, opponent_info)
+  battle.round += 1
+  battle.actions += f"{combat.ACTION_CODES[challenger_action]}{combat.ACTION_CODES[opponent_action]}"
+
+  updated_challenger_info = (updated_c_hp, challenger_action, c_atk)
+  updated_opponent_info = (updated_o_hp, opponent_action, o_atk)
+
+  # Produce appropriate log
+  new_logs = [generate_battle_log(updated_challenger_info, updated_opponent_info, battle)]
+
+  win_log = generate_win_log(updated_c_hp, updated_o_hp, battle)
+  if win_log:
+    new_logs.append(win_log)
+    # Loaded without flushing, so the battle's changes still go out in one UPDATE
+    with db.session.no_autoflush:
+      challenger, opponent = battlers or get_battlers(battle)
+    end_battle(battle, challenger, opponent)
+    winner = None if updated_c_hp == 0 and updated_o_hp == 0 else (
+             opponent if updated_c_hp == 0 else challenger)
+    if winner:
+      increment_winner_stats(winner)
+  return new_logs
+
+AUTO_STRATEGIES = combat.ACTIONS + ["random"]
+MAX_AUTO_ROUNDS = 1000
+
+def auto_battle(actor_id, strategy, bid):
+  battle, code = find_battle_actor(actor_id, bid)
+  if code != 200:
+    return battle, code # error message
 
-    (updated_c_hp, updated_o_hp), c_atk, o_atk = calculate_hp_and_atk(challenger_info, opponent_info)
-    
-    updated_challenger_info = (updated_c_hp, challenger_action, c_atk)
-    updated_opponent_info = (updated_o_hp, opponent_action, o_atk)
+  if battle.opponent_id is not None:
+    return "Only battles against the AI can be auto-battled!", 403
+
+  # Every round is played in memory and written back in one go
+  new_logs = []
+  for _ in range(MAX_AUTO_ROUNDS):
+    if battle.done:
+      break
+    rng = round_rng(battle.seed, battle.round)
+    # The AI draws first, as it does in update_battle_action
+    opponent_action = ai_action(rng)
+    challenger_action = ai_action(rng) if strategy == "random" else strategy
+    new_logs += resolve_round(battle, challenger_action, opponent_action)
+
+  # Bulk saved logs never get their ids back, so watchers are sent whatever follows the last known log
+  last_lid = get_last_log_id(battle.id) if broadcaster.is_watched(battle.id) else None
+  db.session.bulk_save_objects(new_logs)
+  if battle.done:
+    record_battle_stats(battle)
+  db.session.commit()
+  if last_lid is not None:
+    broadcaster.publish(battle.id, get_battle_events(battle.id, last_lid))
+  return battle.serialize(), 200
 
-    # Produce and insert appropriate log
-    new_log = generate_battle_log(updated_challenger_info, updated_opponent_info, battle)
-    add_log(new_log, battle.id)
+def round_rng(seed, round):
+  # A generator of its own for every round, so any round's draws can be made
+  # again from the battle's seed alone
+  return random.Random(f"{seed}-{round}")
 
-    win_log, winner_id = generate_win_log(updated_c_hp, updated_o_hp, battle)
-    if win_log:
-      add_log(win_log, battle.id)
-      if winner_id:
-        increment_winner_stats(winner_id)
-      battle.done = True
+def ai_action(rng):
+  return combat.ACTIONS[rng.randint(0,2)]
 
-    # Prepare Action for next round
-    battle.action[0].challenger_action = None
-    battle.action[0].opponent_action = None
+def get_battle_events(bid, after):
+  state = db.session.query(Battle.done, Battle.archive != None).filter_by(id=bid).first()
+  if state is None:
+    return None
+  done, archived = state
+  if archived:
+    logs = [log for log in Battle.query.filter_by(id=bid).first().get_logs() if log.id > after]
+  else:
+    logs = Log.query.filter(Log.battle_id == bid, Log.id > after).order_by(Log.id).all()
+  return broadcast.encode_events([log.serialize() for log in logs], done)
+
+def publish_logs(bid, new_logs):
+  # Called after commit so watchers only ever see saved logs. Takes the id
+  # since reading it off the committed battle would load the battle again.
+  if new_logs and broadcaster.is_watched(bid):
+    done = db.session.query(Battle.done).filter_by(id=bid).scalar()
+    broadcaster.publish(bid, broadcast.encode_events([log.serialize() for log in new_logs], done))
+
+def end_battle(battle, challenger, opponent):
+  battle.done = True
+  outcome = battle_outcome(battle)
+  for battler, battler_outcome in ((challenger, outcome), (opponent, FLIPPED_OUTCOMES[outcome])):
+    if battler is not None:
+      if battler.active_battle_id == battle.id:
+        battler.active_battle_id = None
+      # Added in SQL, inside the UPDATE the battler gets anyway
+      setattr(battler, battler_outcome, getattr(Character, battler_outcome) + 1)
+      battler.rounds_fought = Character.rounds_fought + battle.round
+
+def battle_outcome(battle):
+  return down_outcome(battle.challenger_hp == 0, battle.opponent_hp == 0)
+
+def get_battlers(battle):
+  # Both battlers in one query, the AI has no character of its own
+  ids = [battler_id for battler_id in (battle.challenger_id, battle.opponent_id) if battler_id is not None]
+  battlers = {c.id: c for c in Character.query.filter(Character.id.in_(ids))}
+  return battlers.get(battle.challenger_id), battlers.get(battle.opponent_id)
 
 def get_actor_response(battle, actor_type):
   return battle.action[0].challenger_action if actor_type == "challenger" else (
          battle.action[0].opponent_action if actor_type == "opponent" else None)
 
-def get_battler_stat(battler_id, stat):
-  battler = Character.query.filter_by(id=battler_id).first()
-  return battler.serialize()[stat]
-
-def get_battler_weapon_stat(battler_id):
-  battler = Character.query.filter_by(id=battler_id).first()
-  weapon = battler.serialize()["equipped"]
-  return 0 if weapon is None else weapon["atk"]
+def get_battler_atk(battler):
+  weapon = battler.get_weapon()
+  return battler.atk + (0 if weapon is None else weapon["atk"])
 
 def calculate_hp_and_atk(c_info, o_info):
-  c_hp, c_act, c_atk = c_info
-  o_hp, o_act, o_atk = o_info
-  if c_act == "Attack":
-    if o_act == "Attack":
-      return nonnegate(c_hp - o_atk, o_hp - c_atk), c_atk, o_atk
-    if o_act == "Defend":
-      return nonnegate(c_hp, o_hp - 0.5 * c_atk), 0.5 * c_atk, 0
-    if o_act == "Counter":
-      return nonnegate(c_hp - 2 * o_atk, o_hp), 0, 2 * o_atk
-  elif c_act == "Defend":
-    if o_act == "Attack":
-      return nonnegate(c_hp - 0.5 * o_atk, o_hp), 0, 0.5 * o_atk
-    if o_act == "Defend":
-      return (c_hp, o_hp), 0, 0
-    if o_act == "Counter":
-      return nonnegate(c_hp, o_hp - c_atk), c_atk, 0
-  elif c_act == "Counter":
-    if o_act == "Attack":
-      return nonnegate(c_hp, o_hp - 2 * c_atk), 2 * c_atk, 0
-    if o_act == "Defend":
-      return nonnegate(c_hp - o_atk, o_hp), 0, o_atk
-    if o_act == "Counter":
-      return (c_hp, o_hp), 0, 0
-
-def increment_winner_stats(cid):
-  winner = Character.query.filter_by(id=cid).first()
-  winner.mhp += 4
-  winner.atk += 2
-
-nonnegate = lambda c_hp, o_hp: (0 if c_hp < 0 else c_hp, 0 if o_hp < 0 else o_hp)
+  return combat.resolve(c_info, o_info)
+
+def increment_winner_stats(winner):
+  winner.mhp += combat.MHP_INCREMENT
+  winner.atk += combat.ATK_INCREMENT
+  touch_users([winner.user_id])
 
 ##########
 #  LOGS  #
 ##########
 
 def create_log(timestamp, challenger_hp, opponent_hp, action, bid):
-  if get_battle(bid) is None:
+  battle = Battle.query.filter_by(id=bid).first()
+  if battle is None:
     return None
 
+  if battle.archive is not None:
+    restore_logs(battle)
+  new_log = build_log(timestamp, challenger_hp, opponent_hp, battle, LOG_CUSTOM, action=action)
+  db.session.add(new_log)
+  db.session.commit()
+  publish_logs(bid, [new_log])
+  return new_log
+
+def build_log(timestamp, challenger_hp, opponent_hp, battle, kind, **fields):
+  # Only what happened is stored, Log.serialize() puts it into words
   new_log = Log(
     timestamp=timestamp,
     challenger_hp=challenger_hp,
     opponent_hp=opponent_hp,
-    action=action,
-    bid=bid
+    kind=kind,
+    round=battle.round,
+    bid=battle.id,
+    **fields
   )
 
-  db.session.add(new_log)
-  db.session.commit()
+  # The newest log always holds the battle's current HP
+  battle.challenger_hp = challenger_hp
+  battle.opponent_hp = opponent_hp
+  touch_battle(battle)
   return new_log
 
-def create_starter_log(challenger, opponent, bid):
-  opponent_name = "AI" if opponent is None else opponent.name
-  action = f"The battle between Challenger {challenger.name} and Opponent {opponent_name} has begun."
-  opponent_mhp = challenger.mhp if opponent is None else opponent.mhp
-  return create_log(
+def generate_starter_log(battle):
+  return build_log(
     timestamp=time.time_ns(),
-    challenger_hp=challenger.mhp,
-    opponent_hp=opponent_mhp,
-    action=action,
-    bid=bid
+    challenger_hp=battle.challenger_hp,
+    opponent_hp=battle.opponent_hp,
+    battle=battle,
+    kind=LOG_START
   )
 
 def generate_battle_log(c_info, o_info, battle):
   c_hp, c_act, c_atk = c_info
   o_hp, o_act, o_atk = o_info
-  c_name = get_battler_stat(battle.challenger_id, "name")
-  o_name = "AI"
-  if battle.opponent_id is not None:
-    o_name = get_battler_stat(battle.opponent_id, "name")
-  action = (f"Challenger {c_name} used {c_act} and dealt {c_atk} damage! "
-           f"Opponent {o_name} used {o_act} and dealt {o_atk} damage!")
-  return create_log(
+  return build_log(
     timestamp=time.time_ns(),
     challenger_hp=c_hp,
     opponent_hp=o_hp,
-    action=action,
-    bid=battle.id
+    battle=battle,
+    kind=LOG_ROUND,
+    challenger_action=combat.ACTION_CODES[c_act],
+    opponent_action=combat.ACTION_CODES[o_act],
+    challenger_dealt=c_atk,
+    opponent_dealt=o_atk
   )
 
 def generate_win_log(c_hp, o_hp, battle):
-  action = None
-  winner_id = None
-  if c_hp == 0 and o_hp == 0:
-    action = "The battle has ended by draw"
-  elif c_hp == 0:
-    winner_id = battle.opponent_id
-    winner_name = "AI"
-    if winner_id is not None:
-      winner_name = get_battler_stat(winner_id, "name")
-    action = f"{winner_name} has won the battle!!!"
-  elif o_hp == 0:
-    winner_id = battle.challenger_id
-    winner_name = get_battler_stat(winner_id, "name")
-    action = f"{winner_name} has won the battle!!!"
-
-  return create_log(
+  if c_hp != 0 and o_hp != 0:
+    return None
+  return build_log(
     timestamp=time.time_ns(),
     challenger_hp=c_hp,
     opponent_hp=o_hp,
-    action=action,
-    bid=battle.id
-  ) if action else None, winner_id
-  
+    battle=battle,
+    kind=LOG_DRAW if c_hp == 0 and o_hp == 0 else LOG_WIN
+  )
+
 def get_log(bid, lid):
   return validate_log_request(bid, lid, delete=False)
 
@@ -434,24 +694,95 @@ def delete_log(bid, lid):
   return validate_log_request(bid, lid, delete=True)
 
 def validate_log_request(bid, lid, delete):
-  battle = get_battle(bid)
-  if battle is None:
-    return "The provided battle does not exist!", 404
-  
-  log = Log.query.filter_by(id=lid).first()
-  if log is None:
-    return "This log does not exist!", 404
-  
-  serialized_log = log.serialize()
-  if serialized_log not in battle["logs"]:
-    return "This log does not belong to the provided battle!", 403
+  log, code = find_log(bid, lid)
+  if code != 200:
+    return log, code # error message
 
+  serialized_log = log.serialize()
   if delete:
+    if log not in db.session:
+      # Replayed from an archive, whose logs have to be rows again before one can go
+      log = next(restored for restored in restore_logs(log.battle) if restored.id == lid)
     db.session.delete(log)
+    restore_battle_hp(bid)
     db.session.commit()
     return serialized_log, 202
   return serialized_log, 200
 
+def find_log(bid, lid):
+  log = Log.query.filter_by(id=lid, battle_id=bid).first()
+  if log is not None:
+    return log, 200
+
+  # Only a miss needs the extra lookups to tell the caller what was wrong
+  battle = Battle.query.filter_by(id=bid).first()
+  if battle is None:
+    return "The provided battle does not exist!", 404
+
+  if battle.archive is not None:
+    log = next((log for log in battle.get_logs() if log.id == lid), None)
+    if log is not None:
+      return log, 200
+
+  if Log.query.filter_by(id=lid).first() is None:
+    return "This log does not exist!", 404
+  return "This log does not belong to the provided battle!", 403
+
+def get_last_log_id(bid):
+  return db.session.query(db.func.max(Log.id)).filter_by(battle_id=bid).scalar() or 0
+
+def restore_battle_hp(bid):
+  # Falls back to the newest remaining log in case the deleted one was the latest
+  recent_log = Log.query.filter_by(battle_id=bid).order_by(Log.id.desc()).first()
+  battle = Battle.query.filter_by(id=bid).first()
+  if recent_log is not None:
+    battle.challenger_hp = recent_log.challenger_hp
+    battle.opponent_hp = recent_log.opponent_hp
+  touch_battle(battle)
+
+###############
+#  ARCHIVING  #
+###############
+
+ARCHIVE_CHUNK_SIZE = 500
+
+def archive_battles():
+  # Swaps finished battles' logs for what replaying them can't give back, a
+  # chunk at a time. Battles whose logs replaying doesn't reproduce exactly,
+  # like ones with posted or deleted logs, keep them.
+  archived = kept = 0
+  after = 0
+  while True:
+    battles = (Battle.query.filter(Battle.done == True, Battle.archive == None, Battle.id > after)
+               .order_by(Battle.id).limit(ARCHIVE_CHUNK_SIZE).all())
+    if not battles:
+      return archived, kept
+    for battle in battles:
+      if archive_battle(battle):
+        archived += 1
+      else:
+        kept += 1
+    after = battles[-1].id
+    db.session.commit()
+
+def archive_battle(battle):
+  logs = battle.logs
+  replayed = battle.replay_logs([log.id for log in logs], [log.timestamp for log in logs])
+  if [log.serialize() for log in replayed] != [log.serialize() for log in logs]:
+    return False
+
+  battle.archive = pack_archive(logs)
+  Log.query.filter_by(battle_id=battle.id).delete(synchronize_session=False)
+  return True
+
+def restore_logs(battle):
+  # Turns an archived battle's replayed logs back into rows, ids and all
+  logs = battle.get_logs()
+  db.session.add_all(logs)
+  battle.archive = None
+  db.session.flush()
+  return logs
+
 ##############
 #  REQUESTS  #
 ##############
@@ -487,10 +818,10 @@ def create_request(kind, sender_id, receiver_id):
     if check_battle_pending(sender_id, receiver_id):
       return "There is already a pending battle request between these characters!", 403
 
-    if is_battling(sender_id):
+    if is_battling(sender):
       return "The sender is already in a battle!", 403
 
-    if is_battling(receiver_id):
+    if is_battling(receiver):
       return "The receiver is already in a battle!", 403
 
     if sender.user_id == receiver.user_id:
@@ -571,9 +902,10 @@ def respond_to_request(rid, receiver_id, accepted):
     if request.kind == "friend":
       receiver.friends.append(sender)
       sender.friends.append(receiver)
+      touch_users([receiver.id, sender.id])
       response = receiver.serialize()
     elif request.kind == "battle":
-      response, _ = create_battle(request.character_sender_id, receiver_id)
+      response, _ = start_battle(request.character_sender_id, receiver_id)
   
   request.accepted = accepted
   db.session.commit()
@@ -591,4 +923,164 @@ def get_request_id(of, request):
     elif of == "receiver":
       return request.character_receiver_id
   
-  
\ No newline at end of file
+  
+
+###############
+#  ANALYTICS  #
+###############
+
+def increment_statement(table, keys, counters):
+  # Adds to counters in SQL, so battles finishing at once can't lose each
+  # other's counts. Run with executemany over rows of key_ and add_ values.
+  return table.update().where(and_(*[table.c[key] == bindparam("key_" + key) for key in keys])).values(
+    {counter: table.c[counter] + bindparam("add_" + counter) for counter in counters})
+
+MATCHUP_INCREMENT = increment_statement(MatchupStat.__table__, ["challenger_action", "opponent_action"],
+                                        ["rounds", "challenger_dealt", "opponent_dealt"] + list(OUTCOMES))
+ROUND_INCREMENT = increment_statement(RoundStat.__table__, ["bucket"], ["battles", "rounds"])
+
+# Keyed by the character, whose weapon is looked up in the same statement
+weapon_table = Weapon.__table__
+WEAPON_INCREMENT = weapon_table.update().where(weapon_table.c.id.in_(
+  Query(Character.weapon_id).filter(Character.id == bindparam("key_character")))).values(
+  {counter: weapon_table.c[counter] + bindparam("add_" + counter) for counter in OUTCOMES + ("rounds_fought",)})
+
+CHARACTER_INCREMENT = increment_statement(Character.__table__, ["id"], OUTCOMES + ("rounds_fought",))
+WEAPON_TOTAL_INCREMENT = increment_statement(Weapon.__table__, ["id"], OUTCOMES + ("rounds_fought",))
+
+round_bucket = lambda rounds: bisect.bisect_left(ROUND_BUCKETS, rounds)
+
+def outcome_counts(outcome, won=1):
+  return {"add_" + name: won if name == outcome else 0 for name in OUTCOMES}
+
+def record_battle_stats(battle):
+  # Folds a battle that just ended into the running totals, with its logs in
+  # the session. The rounds are summed by SQL over the battle_id index;
+  # end_battle already counted the battlers themselves.
+  outcome = battle_outcome(battle)
+  matchups = db.session.query(
+    Log.challenger_action, Log.opponent_action, func.count(Log.id),
+    func.sum(Log.challenger_dealt), func.sum(Log.opponent_dealt), func.max(Log.round)
+  ).filter(Log.battle_id == battle.id, Log.kind == LOG_ROUND).group_by(
+    Log.challenger_action, Log.opponent_action).all()
+  if matchups:
+    db.session.execute(MATCHUP_INCREMENT, [
+      dict(outcome_counts(outcome, int(last_round == battle.round)), key_challenger_action=c_act,
+           key_opponent_action=o_act, add_rounds=rounds, add_challenger_dealt=c_dealt,
+           add_opponent_dealt=o_dealt)
+      for c_act, o_act, rounds, c_dealt, o_dealt, last_round in matchups])
+
+  db.session.execute(ROUND_INCREMENT, {"key_bucket": round_bucket(battle.round), "add_battles": 1,
+                                       "add_rounds": battle.round})
+  sides = ((battle.challenger_id, outcome), (battle.opponent_id, FLIPPED_OUTCOMES[outcome]))
+  db.session.execute(WEAPON_INCREMENT, [dict(outcome_counts(side_outcome), key_character=cid,
+                                             add_rounds_fought=battle.round)
+                                        for cid, side_outcome in sides if cid is not None])
+
+def rebuild_analytics(conn):
+  # Recounts every total from the whole battle history, for databases filled
+  # some other way than through the API. Weapons are credited with their
+  # current holders' records, which is all the history keeps.
+  battle, log = Battle.__table__, Log.__table__
+  totals = list(OUTCOMES) + ["rounds_fought"]
+  for table, counters in ((MatchupStat.__table__, ["rounds", "challenger_dealt", "opponent_dealt"] + list(OUTCOMES)),
+                          (RoundStat.__table__, ["battles", "rounds"]),
+                          (Character.__table__, totals), (Weapon.__table__, totals)):
+    conn.execute(table.update().values({counter: 0 for counter in counters}))
+
+  matchups = {}
+  rounds = Query([log.c.challenger_action, log.c.opponent_action, func.count(log.c.id),
+                  func.sum(log.c.challenger_dealt), func.sum(log.c.opponent_dealt)]).filter(
+    log.c.kind == LOG_ROUND).group_by(log.c.challenger_action, log.c.opponent_action)
+  for c_act, o_act, count, c_dealt, o_dealt in conn.execute(rounds.statement):
+    add_matchup(matchups, c_act, o_act, count, c_dealt, o_dealt)
+  final_rounds = Query([log.c.challenger_action, log.c.opponent_action, battle.c.challenger_hp == 0,
+                        battle.c.opponent_hp == 0, func.count(log.c.id)]).filter(
+    log.c.battle_id == battle.c.id, log.c.round == battle.c.round, log.c.kind == LOG_ROUND,
+    battle.c.done == True).group_by(log.c.challenger_action, log.c.opponent_action,
+                                    battle.c.challenger_hp == 0, battle.c.opponent_hp == 0)
+  for c_act, o_act, c_down, o_down, count in conn.execute(final_rounds.statement):
+    matchups[c_act, o_act]["add_" + down_outcome(c_down, o_down)] += count
+  # Archived battles have no log rows left, so their rounds are replayed
+  archived = Query([battle.c.challenger_mhp, battle.c.opponent_mhp, battle.c.challenger_atk, battle.c.opponent_atk,
+                    battle.c.actions, battle.c.challenger_hp == 0, battle.c.opponent_hp == 0]).filter(
+    battle.c.archive != None)
+  for c_mhp, o_mhp, c_atk, o_atk, actions, c_down, o_down in conn.execute(archived.statement):
+    final = None
+    for c_act, o_act, _, _, c_dealt, o_dealt in combat.replay(c_mhp, o_mhp, c_atk, o_atk, actions):
+      final = add_matchup(matchups, combat.ACTION_CODES[c_act], combat.ACTION_CODES[o_act], 1, c_dealt, o_dealt)
+    if final is not None:
+      final["add_" + down_outcome(c_down, o_down)] += 1
+  if matchups:
+    conn.execute(MATCHUP_INCREMENT, list(matchups.values()))
+
+  buckets = {}
+  for battle_rounds, count in conn.execute(Query([battle.c.round, func.count(battle.c.id)]).filter(
+      battle.c.done == True).group_by(battle.c.round).statement):
+    bucket = buckets.setdefault(round_bucket(battle_rounds), {"add_battles": 0, "add_rounds": 0})
+    bucket["add_battles"] += count
+    bucket["add_rounds"] += count * battle_rounds
+  if buckets:
+    conn.execute(ROUND_INCREMENT, [dict(counts, key_bucket=bucket) for bucket, counts in buckets.items()])
+
+  characters = {}
+  for side, flip in ((battle.c.challenger_id, False), (battle.c.opponent_id, True)):
+    per_side = Query([side, battle.c.challenger_hp == 0, battle.c.opponent_hp == 0, func.count(battle.c.id),
+                      func.sum(battle.c.round)]).filter(battle.c.done == True, side != None).group_by(
+      side, battle.c.challenger_hp == 0, battle.c.opponent_hp == 0)
+    for cid, c_down, o_down, count, battle_rounds in conn.execute(per_side.statement):
+      outcome = down_outcome(c_down, o_down)
+      counts = characters.setdefault(cid, dict(outcome_counts(None), key_id=cid, add_rounds_fought=0))
+      counts["add_" + (FLIPPED_OUTCOMES[outcome] if flip else outcome)] += count
+      counts["add_rounds_fought"] += battle_rounds
+  if characters:
+    conn.execute(CHARACTER_INCREMENT, list(characters.values()))
+
+  character = Character.__table__
+  weapons = Query([character.c.weapon_id] + [func.sum(character.c[counter]) for counter in
+                                              OUTCOMES + ("rounds_fought",)]).filter(
+    character.c.weapon_id != None).group_by(character.c.weapon_id)
+  rows = [dict(zip(["key_id"] + ["add_" + counter for counter in OUTCOMES + ("rounds_fought",)], row))
+          for row in conn.execute(weapons.statement)]
+  if rows:
+    conn.execute(WEAPON_TOTAL_INCREMENT, rows)
+
+def add_matchup(matchups, c_act, o_act, rounds, c_dealt, o_dealt):
+  counts = matchups.setdefault((c_act, o_act), dict(
+    outcome_counts(None), key_challenger_action=c_act, key_opponent_action=o_act,
+    add_rounds=0, add_challenger_dealt=0, add_opponent_dealt=0))
+  counts["add_rounds"] += rounds
+  counts["add_challenger_dealt"] += c_dealt
+  counts["add_opponent_dealt"] += o_dealt
+  return counts
+
+def down_outcome(c_down, o_down):
+  # The challenger's outcome from which battlers ended on 0 HP
+  return "draws" if c_down and o_down else "losses" if c_down else "wins"
+
+def get_matchup_stats():
+  return [stat.serialize() for stat in
+          MatchupStat.query.order_by(MatchupStat.challenger_action, MatchupStat.opponent_action)]
+
+def get_round_stats():
+  buckets = RoundStat.query.order_by(RoundStat.bucket).all()
+  battles = sum(bucket.battles for bucket in buckets)
+  return {
+    "battles": battles,
+    "mean_rounds": sum(bucket.rounds for bucket in buckets) / battles if battles else None,
+    "buckets": [bucket.serialize() for bucket in buckets]
+  }
+
+def get_character_stats(cid):
+  character = Character.query.filter_by(id=cid).first()
+  if character is None:
+    return "This character does not exist!", 404
+  return character.serialize_stats(), 200
+
+def get_top_characters(limit):
+  # Read straight down the wins index, whose ties are already in id order
+  return [character.serialize_stats() for character in
+          Character.query.order_by(Character.wins.desc(), Character.id.desc()).limit(limit)]
+
+def get_weapon_stats():
+  return [weapon.serialize_stats() for weapon in Weapon.query.order_by(Weapon.id)]
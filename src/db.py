@@ -1,23 +1,57 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, text
+from cache import VersionedCache
+import combat
+import itertools
+import serializer
+import zlib
 
 db = SQLAlchemy()
 
+def set_sqlite_pragmas(engine, pragmas):
+  # Most pragmas only last as long as the connection, so each new one gets them all
+  if engine.dialect.name != "sqlite":
+    return
+
+  @event.listens_for(engine, "connect")
+  def apply_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+      cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+def reset_sequences(conn, tables):
+  # For rows written with explicit ids, which PostgreSQL's sequences don't notice
+  if conn.dialect.name != "postgresql":
+    return
+  for table in tables:
+    if "id" in table.c:
+      conn.execute(text(f"SELECT setval(pg_get_serial_sequence('\"{table.name}\"', 'id'), "
+                        f"(SELECT COALESCE(MAX(id), 0) + 1 FROM \"{table.name}\"), false)"))
+
 friends_table = db.Table("association", db.Model.metadata,
   db.Column("friender_id", db.Integer, db.ForeignKey("user.id")),
-  db.Column("friendee_id", db.Integer, db.ForeignKey("user.id"))
+  db.Column("friendee_id", db.Integer, db.ForeignKey("user.id")),
+  db.Index("ix_association_friender", "friender_id", "friendee_id"),
+  db.Index("ix_association_friendee", "friendee_id", "friender_id")
   )
 
 class User(db.Model):
   __tablename__ = "user"
   id = db.Column(db.Integer, primary_key=True)
   username = db.Column(db.String, nullable=False)
+  # Bumped whenever anything serialize() shows changes, friends' characters included
+  version = db.Column(db.Integer, nullable=False)
   characters = db.relationship('Character', cascade="delete")
   friends = db.relationship('User', secondary=friends_table, 
                             primaryjoin=id==friends_table.c.friender_id,
                             secondaryjoin=id==friends_table.c.friendee_id)
+  # Ids are never reused, so a version is never mistaken for a deleted user's
+  __table_args__ = {"sqlite_autoincrement": True}
 
   def __init__(self, **kwargs):
     self.username = kwargs.get("username", "")
+    self.version = 1
     self.characters = []
     self.friends = []
 
@@ -43,14 +77,24 @@ class Character(db.Model):
   mhp = db.Column(db.Integer, nullable=False)
   atk = db.Column(db.Integer, nullable=False)
   weapon_id = db.Column(db.Integer, db.ForeignKey("weapon.id"))
-  user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+  user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
+  # The battle this character is fighting right now, if any
+  active_battle_id = db.Column(db.Integer, db.ForeignKey("battle.id", use_alter=True,
+                                                         name="fk_character_active_battle"))
+  # Running totals over finished battles, for analytics. Indexed for the leaderboard.
+  wins = db.Column(db.Integer, nullable=False, index=True)
+  losses = db.Column(db.Integer, nullable=False)
+  draws = db.Column(db.Integer, nullable=False)
+  rounds_fought = db.Column(db.Integer, nullable=False)
 
   def __init__(self, **kwargs):
     self.name = kwargs.get("name", "")
-    self.mhp = 10
-    self.atk = 2
+    self.mhp = combat.STARTING_MHP
+    self.atk = combat.STARTING_ATK
     self.weapon_id = None
     self.user_id = kwargs.get("uid", 0)
+    self.active_battle_id = None
+    self.wins = self.losses = self.draws = self.rounds_fought = 0
 
   def serialize(self):
     return {
@@ -61,22 +105,30 @@ class Character(db.Model):
       "equipped": self.get_weapon()
     }
   
+  def serialize_stats(self):
+    return dict(id=self.id, name=self.name, **serialize_outcomes(self))
+
   def get_weapon(self):
-    weapon = Weapon.query.filter_by(id=self.weapon_id).first()
-    if weapon is None:
+    if self.weapon_id is None:
       return None
-    return weapon.serialize()
+    return weapon_cache.get(self.weapon_id, load_weapon)
 
 class Weapon(db.Model):
   __tablename__ = "weapon"
   id = db.Column(db.Integer, primary_key=True)
   name = db.Column(db.String, nullable=False)
   atk = db.Column(db.Integer, nullable=False)
+  # Running totals over finished battles fought with this weapon equipped
+  wins = db.Column(db.Integer, nullable=False)
+  losses = db.Column(db.Integer, nullable=False)
+  draws = db.Column(db.Integer, nullable=False)
+  rounds_fought = db.Column(db.Integer, nullable=False)
 
   def __init__(self, **kwargs):
     self.name = kwargs.get("name", "")
     atk = kwargs.get("atk", 1)
     self.atk = 1 if atk < 1 else atk
+    self.wins = self.losses = self.draws = self.rounds_fought = 0
 
   def serialize(self):
     return {
@@ -85,14 +137,59 @@ class Weapon(db.Model):
       "atk": self.atk
     }
 
+  def serialize_stats(self):
+    return dict(id=self.id, name=self.name, atk=self.atk, **serialize_outcomes(self))
+
+class Catalog(db.Model):
+  # Versions for whole collections, like the weapon list, that have no row of their own
+  __tablename__ = "catalog"
+  name = db.Column(db.String, primary_key=True)
+  version = db.Column(db.Integer, nullable=False)
+
+  def __init__(self, **kwargs):
+    self.name = kwargs.get("name", "")
+    self.version = 1
+
 class Battle(db.Model):
   __tablename__ = "battle"
   id = db.Column(db.Integer, primary_key=True)
   challenger_id = db.Column(db.Integer, db.ForeignKey("character.id"), nullable=False)
   opponent_id = db.Column(db.Integer, db.ForeignKey("character.id"))
-  logs = db.relationship('Log', cascade="delete")
+  logs = db.relationship('Log', cascade="delete", order_by="Log.id")
   action = db.relationship('Action', cascade="delete")
   done = db.Column(db.Boolean, nullable=False)
+  # Live state, kept in step with the newest log so a round never has to
+  # read the battle's history
+  challenger_hp = db.Column(db.Integer, nullable=False)
+  opponent_hp = db.Column(db.Integer, nullable=False)
+  challenger_atk = db.Column(db.Integer, nullable=False)
+  opponent_atk = db.Column(db.Integer, nullable=False)
+  round = db.Column(db.Integer, nullable=False)
+  # Names as they were when the battle began, for rendering its logs.
+  # No opponent name means the AI.
+  challenger_name = db.Column(db.String, nullable=False)
+  opponent_name = db.Column(db.String)
+  # Bumped whenever the logs change
+  version = db.Column(db.Integer, nullable=False)
+  # Enough to play the battle again: the AI's moves are drawn from the seed,
+  # actions holds both battlers' ACTION_CODES for every round, two digits a
+  # round, and the starting HP is kept since the live HP only has the latest
+  seed = db.Column(db.Integer, nullable=False)
+  actions = db.Column(db.String, nullable=False)
+  challenger_mhp = db.Column(db.Integer, nullable=False)
+  opponent_mhp = db.Column(db.Integer, nullable=False)
+  # Set once a finished battle's logs are replaced by what replaying can't
+  # give back, their ids and timestamps (see pack_archive)
+  archive = db.Column(db.LargeBinary)
+  # Only battles still in progress are ever looked up by battler, and ids
+  # are never reused so a version is never mistaken for a deleted battle's
+  __table_args__ = (
+    db.Index("ix_battle_active_challenger", challenger_id,
+             sqlite_where=done == False, postgresql_where=done == False),
+    db.Index("ix_battle_active_opponent", opponent_id,
+             sqlite_where=done == False, postgresql_where=done == False),
+    {"sqlite_autoincrement": True}
+  )
 
   def __init__(self, **kwargs):
     self.challenger_id = kwargs.get("challenger_id", 0)
@@ -100,30 +197,101 @@ class Battle(db.Model):
     self.logs = []
     self.action = [] # one element list
     self.done = False
+    self.challenger_hp = kwargs.get("challenger_hp", 0)
+    self.opponent_hp = kwargs.get("opponent_hp", 0)
+    self.challenger_atk = kwargs.get("challenger_atk", 0)
+    self.opponent_atk = kwargs.get("opponent_atk", 0)
+    self.round = 0
+    self.challenger_name = kwargs.get("challenger_name", "")
+    self.opponent_name = kwargs.get("opponent_name", None)
+    self.version = 1
+    self.seed = kwargs.get("seed", 0)
+    self.actions = ""
+    self.challenger_mhp = self.challenger_hp
+    self.opponent_mhp = self.opponent_hp
+    self.archive = None
 
   def serialize(self):
     return {
       "id": self.id,
       "challenger_id": self.challenger_id,
       "opponent_id": self.opponent_id,
-      "logs": [log.serialize() for log in self.logs],
+      "logs": [log.serialize() for log in self.get_logs()],
       "done": self.done
     }
 
+  def get_logs(self):
+    if self.archive is None:
+      return self.logs
+    return self.replay_logs(*unpack_archive(self.archive))
+
+  def replay_logs(self, ids, timestamps):
+    # The logs the battle wrote, rebuilt from its starting HP and actions as
+    # unsaved Logs with the given ids and timestamps
+    fields = [dict(kind=LOG_START, round=0, challenger_hp=self.challenger_mhp, opponent_hp=self.opponent_mhp)]
+    replayed = combat.replay(self.challenger_mhp, self.opponent_mhp, self.challenger_atk, self.opponent_atk, self.actions)
+    for round, (c_act, o_act, c_hp, o_hp, c_dealt, o_dealt) in enumerate(replayed, 1):
+      fields.append(dict(kind=LOG_ROUND, round=round, challenger_hp=c_hp, opponent_hp=o_hp,
+                         challenger_action=combat.ACTION_CODES[c_act], opponent_action=combat.ACTION_CODES[o_act],
+                         challenger_dealt=c_dealt, opponent_dealt=o_dealt))
+    last = fields[-1]
+    if last["challenger_hp"] == 0 or last["opponent_hp"] == 0:
+      fields.append(dict(last, kind=LOG_DRAW if last["challenger_hp"] == last["opponent_hp"] else LOG_WIN,
+                         challenger_action=None, opponent_action=None, challenger_dealt=None, opponent_dealt=None))
+
+    logs = []
+    for lid, timestamp, log_fields in zip(ids, timestamps, fields):
+      log = Log(timestamp=timestamp, bid=self.id, **log_fields)
+      log.id = lid
+      log.battle = self
+      logs.append(log)
+    return logs
+
+# Log ids and timestamps both grow, so their gaps are stored instead, as JSON and compressed
+def pack_archive(logs):
+  ids = [log.id for log in logs]
+  timestamps = [log.timestamp for log in logs]
+  return zlib.compress(serializer.dumps([gaps(ids), gaps(timestamps)]))
+
+def unpack_archive(archive):
+  return [list(itertools.accumulate(column)) for column in serializer.loads(zlib.decompress(archive))]
+
+gaps = lambda values: [value - previous for previous, value in zip([0] + values, values)]
+
+# What a log records. Only custom logs, posted through the API, keep their text.
+LOG_START, LOG_ROUND, LOG_WIN, LOG_DRAW, LOG_CUSTOM = range(5)
+
 class Log(db.Model):
   __tablename__ = "log"
   id = db.Column(db.Integer, primary_key=True)
-  timestamp = db.Column(db.Integer, nullable=False)
+  # Nanoseconds outgrow a 32 bit integer, which PostgreSQL's INTEGER is
+  timestamp = db.Column(db.BigInteger, nullable=False)
   challenger_hp = db.Column(db.Integer, nullable=False)
   opponent_hp = db.Column(db.Integer, nullable=False)
-  action = db.Column(db.String, nullable=False)
-  battle_id = db.Column(db.Integer, db.ForeignKey("battle.id"), nullable=False)
+  kind = db.Column(db.SmallInteger, nullable=False)
+  round = db.Column(db.Integer, nullable=False)
+  # Indices into combat.ACTIONS, for round logs
+  challenger_action = db.Column(db.SmallInteger)
+  opponent_action = db.Column(db.SmallInteger)
+  challenger_dealt = db.Column(db.Float)
+  opponent_dealt = db.Column(db.Float)
+  action = db.Column(db.String)
+  battle_id = db.Column(db.Integer, db.ForeignKey("battle.id"), nullable=False, index=True)
+  # Read for the names when rendering, which the session already holds
+  # whenever the battle itself was loaded
+  battle = db.relationship("Battle", viewonly=True)
 
   def __init__(self, **kwargs):
     self.timestamp = kwargs.get("timestamp", 0)
     self.challenger_hp = kwargs.get("challenger_hp", 0)
     self.opponent_hp = kwargs.get("opponent_hp", 0)
-    self.action = kwargs.get("action", "")
+    self.kind = kwargs.get("kind", LOG_CUSTOM)
+    self.round = kwargs.get("round", 0)
+    self.challenger_action = kwargs.get("challenger_action", None)
+    self.opponent_action = kwargs.get("opponent_action", None)
+    self.challenger_dealt = kwargs.get("challenger_dealt", None)
+    self.opponent_dealt = kwargs.get("opponent_dealt", None)
+    self.action = kwargs.get("action", None)
     self.battle_id = kwargs.get("bid", 0)
 
   def serialize(self):
@@ -132,9 +300,106 @@ class Log(db.Model):
       "timestamp": self.timestamp,
       "challenger_hp": self.challenger_hp,
       "opponent_hp": self.opponent_hp,
-      "action": self.action
+      "action": self.render_action()
     }
 
+  def render_action(self):
+    if self.kind == LOG_CUSTOM:
+      return self.action
+    if self.kind == LOG_DRAW:
+      return "The battle has ended by draw"
+
+    c_name = self.battle.challenger_name
+    o_name = self.battle.opponent_name or "AI"
+    if self.kind == LOG_START:
+      return f"The battle between Challenger {c_name} and Opponent {o_name} has begun."
+    if self.kind == LOG_WIN:
+      return f"{o_name if self.challenger_hp == 0 else c_name} has won the battle!!!"
+
+    c_act, o_act = self.challenger_action, self.opponent_action
+    c_dealt = format_dealt(combat.CHALLENGER_DEALT[c_act][o_act], self.challenger_dealt)
+    o_dealt = format_dealt(combat.OPPONENT_DEALT[c_act][o_act], self.opponent_dealt)
+    return (f"Challenger {c_name} used {combat.ACTIONS[c_act]} and dealt {c_dealt} damage! "
+            f"Opponent {o_name} used {combat.ACTIONS[o_act]} and dealt {o_dealt} damage!")
+
+# Damage comes back from the database as a float, but combat.dealt only ever
+# made one when half an attack landed
+format_dealt = lambda share, dealt: dealt if share % 1 else int(dealt)
+
+# Outcomes are counted from each battler's own side
+OUTCOMES = ("wins", "losses", "draws")
+FLIPPED_OUTCOMES = {"wins": "losses", "losses": "wins", "draws": "draws"}
+
+rate = lambda part, whole: part / whole if whole else None
+
+def serialize_outcomes(stats):
+  battles = stats.wins + stats.losses + stats.draws
+  return {
+    "battles": battles,
+    "wins": stats.wins,
+    "losses": stats.losses,
+    "draws": stats.draws,
+    "win_rate": rate(stats.wins, battles),
+    "mean_rounds": rate(stats.rounds_fought, battles)
+  }
+
+class MatchupStat(db.Model):
+  # Every round played with this pair of actions. The outcome counts are for
+  # battles whose final round it was, from the challenger's side.
+  __tablename__ = "matchup_stat"
+  challenger_action = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+  opponent_action = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+  rounds = db.Column(db.Integer, nullable=False)
+  challenger_dealt = db.Column(db.Float, nullable=False)
+  opponent_dealt = db.Column(db.Float, nullable=False)
+  wins = db.Column(db.Integer, nullable=False)
+  losses = db.Column(db.Integer, nullable=False)
+  draws = db.Column(db.Integer, nullable=False)
+
+  def serialize(self):
+    decided = self.wins + self.losses + self.draws
+    return {
+      "challenger_action": combat.ACTIONS[self.challenger_action],
+      "opponent_action": combat.ACTIONS[self.opponent_action],
+      "rounds": self.rounds,
+      "challenger_mean_dealt": rate(self.challenger_dealt, self.rounds),
+      "opponent_mean_dealt": rate(self.opponent_dealt, self.rounds),
+      "battles_decided": decided,
+      "wins": self.wins,
+      "losses": self.losses,
+      "draws": self.draws,
+      "win_rate": rate(self.wins, decided)
+    }
+
+# Upper bounds of the battle length histogram, the last bucket takes the rest
+ROUND_BUCKETS = (1, 2, 3, 4, 5, 6, 7, 8, 10, 12, 15, 20, 30, 50, 100, 1000)
+
+class RoundStat(db.Model):
+  __tablename__ = "round_stat"
+  bucket = db.Column(db.Integer, primary_key=True, autoincrement=False)
+  battles = db.Column(db.Integer, nullable=False)
+  rounds = db.Column(db.Integer, nullable=False)
+
+  def serialize(self):
+    return {
+      "le": ROUND_BUCKETS[self.bucket] if self.bucket < len(ROUND_BUCKETS) else None,
+      "battles": self.battles
+    }
+
+# Both tables have a row for every key from the start, so recording a battle
+# only ever has to add to existing rows
+@event.listens_for(MatchupStat.__table__, "after_create")
+def create_matchup_rows(table, connection, **kwargs):
+  connection.execute(table.insert(), [
+    {"challenger_action": c_act, "opponent_action": o_act, "rounds": 0, "challenger_dealt": 0,
+     "opponent_dealt": 0, "wins": 0, "losses": 0, "draws": 0}
+    for c_act in range(len(combat.ACTIONS)) for o_act in range(len(combat.ACTIONS))])
+
+@event.listens_for(RoundStat.__table__, "after_create")
+def create_round_rows(table, connection, **kwargs):
+  connection.execute(table.insert(), [{"bucket": bucket, "battles": 0, "rounds": 0}
+                                      for bucket in range(len(ROUND_BUCKETS) + 1)])
+
 class Request(db.Model):
   __tablename__ = "request"
   id = db.Column(db.Integer, primary_key=True)
@@ -144,6 +409,13 @@ class Request(db.Model):
   character_sender_id = db.Column(db.Integer, db.ForeignKey("character.id"))
   character_receiver_id = db.Column(db.Integer, db.ForeignKey("character.id"))
   accepted = db.Column(db.Boolean)
+  # Pending requests are checked in both directions between two parties
+  __table_args__ = (
+    db.Index("ix_request_pending_users", user_sender_id, user_receiver_id,
+             sqlite_where=accepted == None, postgresql_where=accepted == None),
+    db.Index("ix_request_pending_characters", character_sender_id, character_receiver_id,
+             sqlite_where=accepted == None, postgresql_where=accepted == None)
+  )
 
   def __init__(self, **kwargs):
     self.kind = kwargs.get("kind", "")
@@ -175,9 +447,22 @@ class Action(db.Model):
   id = db.Column(db.Integer, primary_key=True)
   challenger_action = db.Column(db.String)
   opponent_action = db.Column(db.String)
-  battle_id = db.Column(db.Integer, db.ForeignKey("battle.id"))
+  battle_id = db.Column(db.Integer, db.ForeignKey("battle.id"), index=True)
 
   def __init__(self, **kwargs):
     self.battle_id = kwargs.get("bid", 0) 
 
+WEAPON_CATALOG = "weapons"
+
+def load_weapon(wid):
+  weapon = Weapon.query.filter_by(id=wid).first()
+  return None if weapon is None else weapon.serialize()
+
+def load_weapons(wids):
+  return {weapon.id: weapon.serialize() for weapon in Weapon.query.filter(Weapon.id.in_(wids))}
+
+def load_weapon_catalog_version():
+  return db.session.query(Catalog.version).filter_by(name=WEAPON_CATALOG).scalar() or 0
 
+# Weapons change only through create_weapon and delete_weapon, both of which bump the catalog
+weapon_cache = VersionedCache(WEAPON_CATALOG, load_weapon_catalog_version)
@@ -0,0 +1,250 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+
+# The test suite, whose helpers the scenarios are made of. Only imported by
+# load_suite(), since importing it sets up the app's database.
+ai_test = None
+
+def load_suite():
+    global ai_test
+    import ai_test
+    return ai_test
+
+###############
+#  SCENARIOS  #
+###############
+
+# Every pairing here ends, unlike Defend against Defend
+def pvp_battle(rng):
+    ai_test.execute_action_to_completion(rng.choice(["Attack", "Counter"]), rng.choice(["Attack", "Defend"]))
+
+def ai_battle(rng):
+    battle = ai_test.create_ai_battle()["data"]
+    ai_test.auto_battle(battle["id"], ai_test.SAMPLE_AUTO_BATTLE(battle["challenger_id"], "random"))
+
+def battle_request(rng):
+    ai_test.respond_to_battle_request()
+
+def friend_request(rng):
+    ai_test.respond_to_friend_request()
+
+def browse(rng):
+    battle = ai_test.create_pvp_battle()["data"]
+    ai_test.get_user_page(limit=100)
+    ai_test.get_weapon()
+    ai_test.get_battle(battle["id"])
+
+SCENARIOS = {
+    "pvp_battle": pvp_battle,
+    "ai_battle": ai_battle,
+    "battle_request": battle_request,
+    "friend_request": friend_request,
+    "browse": browse,
+}
+
+#############
+#  CLIENTS  #
+#############
+
+class HttpClient:
+    # The same calls as ai_test.ApiClient, made over HTTP with a kept-alive session
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+
+    def open(self, method, url, **kwargs):
+        return self.session.request(method, self.base_url + url, **kwargs)
+
+class TimedClient:
+    # Stands in for ai_test.client, giving each worker thread its own client
+    # and timing every call under the route it matched
+
+    def __init__(self, make_client):
+        self.make_client = make_client
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+        self.adapter = ai_test.app.url_map.bind("localhost")
+
+    def open(self, method, url, **kwargs):
+        if not hasattr(self.local, "client"):
+            self.local.client = self.make_client()
+        start = time.perf_counter()
+        res = self.local.client.open(method, url, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        route = f"{method} {self.route(method, url)}"
+        with self.lock:
+            self.samples.setdefault(route, []).append(elapsed)
+            if res.status_code >= 500:
+                self.errors[route] = self.errors.get(route, 0) + 1
+        return res
+
+    def route(self, method, url):
+        try:
+            rule, _ = self.adapter.match(url, method=method, return_rule=True)
+            return rule.rule
+        except Exception:
+            return "unmatched"
+
+    def get(self, url, **kwargs):
+        return self.open("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.open("POST", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.open("DELETE", url, **kwargs)
+
+#############
+#  RUNNING  #
+#############
+
+def run_worker(mix, deadline, iterations, seed, failures):
+    rng = random.Random(seed)
+    names, weights = zip(*mix.items())
+    completed = 0
+    while completed < iterations and time.perf_counter() < deadline:
+        name = rng.choices(names, weights)[0]
+        try:
+            SCENARIOS[name](rng)
+        except Exception as error:
+            failures.append((name, str(error).strip().splitlines()[0] if str(error).strip() else repr(error)))
+        completed += 1
+    return completed
+
+@contextlib.contextmanager
+def serving(client):
+    # Points the suite's helpers at the client until the block ends
+    original, ai_test.client = ai_test.client, client
+    try:
+        yield client
+    finally:
+        ai_test.client = original
+
+def run(mix, concurrency, duration, iterations, seed, client):
+    # Expects the helpers to be going through client, see serving()
+    failures = []
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        scenarios = sum(pool.map(lambda worker: run_worker(mix, deadline, iterations, f"{seed}-{worker}", failures),
+                                 range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return summarize(client, scenarios, failures, elapsed, concurrency)
+
+def summarize(client, scenarios, failures, elapsed, concurrency):
+    routes = {}
+    for route, samples in sorted(client.samples.items()):
+        p50, p95, p99 = np.percentile(samples, [50, 95, 99]) * 1e3
+        routes[route] = {"requests": len(samples), "errors": client.errors.get(route, 0),
+                         "rps": len(samples) / elapsed, "p50_ms": p50, "p95_ms": p95, "p99_ms": p99}
+    total = sum(route["requests"] for route in routes.values())
+    return {"concurrency": concurrency, "seconds": elapsed, "scenarios": scenarios,
+            "failed_scenarios": len(failures), "requests": total, "rps": total / elapsed,
+            "routes": routes, "failures": sorted(set(failures))[:20]}
+
+###############
+#  REPORTING  #
+###############
+
+def print_report(result):
+    print(f"{result['requests']} requests, {result['scenarios']} scenarios "
+          f"({result['failed_scenarios']} failed) in {result['seconds']:.2f} s "
+          f"at concurrency {result['concurrency']}: {result['rps']:.1f} req/s")
+    print(f"{'route':<42} {'reqs':>7} {'5xx':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for route, r in result["routes"].items():
+        print(f"{route:<42} {r['requests']:>7} {r['errors']:>5} {r['rps']:>8.1f} "
+              f"{r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f}")
+    for name, error in result["failures"]:
+        print(f"failed {name}: {error}")
+
+change = lambda new, old: (new - old) / old * 100 if old else 0
+
+def compare(result, baseline):
+    # Returns the worst p95 slowdown, in percent, over routes both runs hit
+    print(f"\nagainst baseline: req/s {change(result['rps'], baseline['rps']):+.1f}%")
+    worst = 0
+    for route, r in result["routes"].items():
+        old = baseline["routes"].get(route)
+        if old is None:
+            continue
+        p95_change = change(r["p95_ms"], old["p95_ms"])
+        worst = max(worst, p95_change)
+        print(f"{route:<42} p50 {change(r['p50_ms'], old['p50_ms']):>+7.1f}%  "
+              f"p95 {p95_change:>+7.1f}%  p99 {change(r['p99_ms'], old['p99_ms']):>+7.1f}%")
+    return worst
+
+#########
+#  CLI  #
+#########
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario {name}, pick from {', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replays weighted mixes of the test suite's scenarios "
+        "and reports latency per route. Runs in-process on a scratch database unless --url is given.")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("pvp_battle=4,ai_battle=2,battle_request=2,"
+                        "friend_request=1,browse=3"), help="comma separated scenario=weight pairs")
+    parser.add_argument("--concurrency", type=int, default=4, help="worker threads")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run for")
+    parser.add_argument("--iterations", type=int, default=sys.maxsize, help="scenarios per worker at most")
+    parser.add_argument("--url", help="run over HTTP against a server at this address, e.g. http://localhost:5000")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="save the results as JSON here")
+    parser.add_argument("--baseline", help="compare against results saved by an earlier --out")
+    parser.add_argument("--max-regression", type=float, help="exit non-zero if any route's p95 is this many "
+                        "percent slower than the baseline")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    with contextlib.ExitStack() as stack:
+        # The in-memory test database is one connection every thread shares
+        # (see config.engine_options), which would interleave the workers'
+        # transactions, so in-process runs get a scratch file instead
+        if not args.url and "TEST_DATABASE_URL" not in os.environ:
+            scratch = stack.enter_context(tempfile.TemporaryDirectory())
+            os.environ["TEST_DATABASE_URL"] = f"sqlite:///{scratch}/loadtest.db"
+        suite = load_suite()
+        if args.url:
+            make_client = lambda: HttpClient(args.url)
+        else:
+            make_client = lambda: suite.ApiClient(suite.app)
+
+        client = stack.enter_context(serving(TimedClient(make_client)))
+        result = run(args.mix, args.concurrency, args.duration, args.iterations, args.seed, client)
+    result["mode"] = args.url or "in-process"
+    result["mix"] = args.mix
+    print_report(result)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            worst = compare(result, json.load(f))
+        if args.max_regression is not None and worst > args.max_regression:
+            sys.exit(f"p95 regressed by {worst:.1f}%, over the allowed {args.max_regression}%")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import bisect
+import functools
+import inspect
+import threading
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+MIMETYPE = "text/plain; version=0.0.4"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250, 1000)
+
+escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+format_labels = lambda names, values: ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+
+class Histogram:
+  # A Prometheus histogram with one series per combination of label values
+
+  def __init__(self, name, help, labels, buckets):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self.buckets = buckets
+    self.lock = threading.Lock()
+    self.series = {}
+
+  def observe(self, values, amount):
+    with self.lock:
+      # One count per bucket plus +Inf, then the sum
+      series = self.series.setdefault(values, [0] * (len(self.buckets) + 2))
+      series[bisect.bisect_left(self.buckets, amount)] += 1
+      series[-1] += amount
+
+  def render(self):
+    lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+    with self.lock:
+      series = sorted((values, list(counts)) for values, counts in self.series.items())
+    for values, counts in series:
+      labels = format_labels(self.labels, values)
+      total = 0
+      for bound, count in zip(self.buckets + ("+Inf",), counts):
+        total += count
+        lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {total}')
+      lines.append(f"{self.name}_sum{{{labels}}} {counts[-1]}")
+      lines.append(f"{self.name}_count{{{labels}}} {total}")
+    return lines
+
+class Gauge:
+  # Read from somewhere else whenever metrics are rendered
+
+  def __init__(self, name, help, read, kind="gauge"):
+    self.name = name
+    self.help = help
+    self.read = read
+    self.kind = kind
+
+  def render(self):
+    return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", f"{self.name} {self.read()}"]
+
+REQUEST_SECONDS = Histogram("ai_request_duration_seconds", "Time spent handling a request.",
+                            ("method", "route", "status"), LATENCY_BUCKETS)
+REQUEST_QUERIES = Histogram("ai_request_queries", "SQL statements run by a request.",
+                            ("method", "route"), QUERY_BUCKETS)
+REQUEST_QUERY_SECONDS = Histogram("ai_request_query_duration_seconds", "Time a request spent in SQL.",
+                                  ("method", "route"), LATENCY_BUCKETS)
+DAO_SECONDS = Histogram("ai_dao_call_duration_seconds", "Time spent in a DAO function, calls it makes included.",
+                        ("route", "function"), LATENCY_BUCKETS)
+DAO_QUERIES = Histogram("ai_dao_call_queries", "SQL statements run by a DAO function, calls it makes included.",
+                        ("route", "function"), QUERY_BUCKETS)
+
+registry = [REQUEST_SECONDS, REQUEST_QUERIES, REQUEST_QUERY_SECONDS, DAO_SECONDS, DAO_QUERIES]
+
+def render():
+  return "\n".join(line for metric in registry for line in metric.render()) + "\n"
+
+class RequestStats:
+
+  def __init__(self, route):
+    self.route = route
+    self.start = time.perf_counter()
+    self.queries = 0
+    self.query_seconds = 0
+    # [function name, queries so far] for every DAO call in progress
+    self.calls = []
+
+def current_stats():
+  return g.get("metrics") if has_request_context() else None
+
+def start_request():
+  # Grouped by the route's template, like SPECIFIC_BATTLE_PATH, not the concrete path
+  g.metrics = RequestStats(request.url_rule.rule if request.url_rule else "unmatched")
+
+def finish_request(response):
+  stats = current_stats()
+  if stats is not None:
+    REQUEST_SECONDS.observe((request.method, stats.route, response.status_code), time.perf_counter() - stats.start)
+    REQUEST_QUERIES.observe((request.method, stats.route), stats.queries)
+    REQUEST_QUERY_SECONDS.observe((request.method, stats.route), stats.query_seconds)
+  return response
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  conn.info["metrics_query_start"] = time.perf_counter()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  start = conn.info.pop("metrics_query_start", None)
+  stats = current_stats()
+  if stats is not None and start is not None:
+    elapsed = time.perf_counter() - start
+    stats.queries += 1
+    stats.query_seconds += elapsed
+    for call in stats.calls:
+      call[1] += 1
+
+def timed(name, function):
+  @functools.wraps(function)
+  def wrapper(*args, **kwargs):
+    stats = current_stats()
+    if stats is None:
+      return function(*args, **kwargs)
+
+    call = [name, 0]
+    stats.calls.append(call)
+    start = time.perf_counter()
+    try:
+      return function(*args, **kwargs)
+    finally:
+      stats.calls.pop()
+      DAO_SECONDS.observe((stats.route, name), time.perf_counter() - start)
+      DAO_QUERIES.observe((stats.route, name), call[1])
+  return wrapper
+
+def instrument(module, names):
+  # Only the named functions, meant to be the entry points routes call, so
+  # helpers run per round or per entry don't each pay for a histogram.
+  # Functions look each other up through the module too, so calls between
+  # named ones are timed as well. Generators can't be, since calling one
+  # only creates it.
+  for name in names:
+    function = getattr(module, name)
+    if inspect.isgeneratorfunction(function):
+      raise ValueError(f"{name} is a generator and can't be timed")
+    setattr(module, name, timed(name, function))
+
+def is_allowed(addresses):
+  # The endpoint is for the operator's scraper, not the public
+  return request.remote_addr in addresses
+
+def init_app(app, engine):
+  app.before_request(start_request)
+  app.after_request(finish_request)
+  event.listen(engine, "before_cursor_execute", before_cursor_execute)
+  event.listen(engine, "after_cursor_execute", after_cursor_execute)
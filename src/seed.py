@@ -0,0 +1,276 @@
+import argparse
+import random
+import time
+import numpy as np
+from sqlalchemy import bindparam, create_engine, func
+from sqlalchemy.orm import Query
+import combat
+import config
+import dao
+from db import (Action, Battle, Catalog, Character, Log, User, Weapon, WEAPON_CATALOG, db, friends_table,
+                reset_sequences, set_sqlite_pragmas, LOG_START, LOG_ROUND, LOG_WIN, LOG_DRAW)
+
+NAMES = ["Ada", "Bruno", "Chalo", "Dana", "Emeka", "Farah", "Goro", "Hana", "Ivo", "Jun",
+         "Kira", "Lior", "Mina", "Nico", "Oona", "Pax", "Quin", "Rhea", "Sol", "Tove"]
+WEAPON_KINDS = ["Sword", "Axe", "Bow", "Spear", "Mace", "Dagger", "Staff", "Hammer"]
+WEAPON_MATERIALS = ["Wooden", "Bronze", "Iron", "Steel", "Mithril", "Obsidian", "Laser", "Plasma"]
+
+# Players lean on Attack, the AI picks evenly like update_battle_action does
+PLAYER_ACTION_WEIGHTS = [0.5, 0.25, 0.25]
+AI_SHARE = 0.4
+EQUIPPED_SHARE = 0.6
+# Battles near the end of the history are left running when their battlers are free
+UNFINISHED_SHARE = 0.01
+
+BASE_TIMESTAMP = 1_600_000_000 * 10**9
+SECOND = 10**9
+
+# Counted afterwards by dao.rebuild_analytics
+NO_STATS = {"wins": 0, "losses": 0, "draws": 0, "rounds_fought": 0}
+# executemany needs every row to name the same columns
+LOG_DEFAULTS = {"challenger_action": None, "opponent_action": None, "challenger_dealt": None,
+                "opponent_dealt": None, "action": None}
+
+SEEDED_TABLES = [User.__table__, Weapon.__table__, Catalog.__table__, Character.__table__,
+                 friends_table, Battle.__table__, Action.__table__, Log.__table__]
+
+#############
+#  HELPERS  #
+#############
+
+def popularity(rng, size, exponent):
+    # Zipf-like weights in a random order, so a few rows get most of the picks
+    weights = 1 / np.arange(1, size + 1) ** exponent
+    return rng.permutation(weights / weights.sum())
+
+class Inserter:
+    # Buffers rows per table and writes them with executemany in batches
+
+    def __init__(self, conn, batch_size):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.pending = {}
+        self.counts = {}
+
+    def add(self, table, row):
+        rows = self.pending.setdefault(table, [])
+        rows.append(row)
+        if len(rows) >= self.batch_size:
+            self.flush(table)
+
+    def flush(self, table):
+        rows = self.pending.pop(table, [])
+        if rows:
+            self.conn.execute(table.insert(), rows)
+            self.counts[table.name] = self.counts.get(table.name, 0) + len(rows)
+
+    def flush_all(self, tables):
+        # In foreign key order, so server databases accept every batch
+        for table in tables:
+            self.flush(table)
+
+#############
+#  SEEDING  #
+#############
+
+def seed_users(inserter, rng, users):
+    for uid in range(1, users + 1):
+        inserter.add(User.__table__, {"id": uid, "username": f"{NAMES[uid % len(NAMES)]}{uid}", "version": 1})
+
+def seed_weapons(inserter, rng, weapons):
+    # Mostly weak weapons with a long tail of strong ones
+    atks = np.minimum(rng.geometric(0.15, weapons), 50)
+    for wid in range(1, weapons + 1):
+        name = f"{rng.choice(WEAPON_MATERIALS)} {rng.choice(WEAPON_KINDS)}"
+        inserter.add(Weapon.__table__, dict(NO_STATS, id=wid, name=name, atk=int(atks[wid - 1])))
+    inserter.add(Catalog.__table__, {"name": WEAPON_CATALOG, "version": 1})
+    return {wid: int(atk) for wid, atk in enumerate(atks, 1)}
+
+def seed_characters(inserter, rng, users, per_user, weapon_atks):
+    # Every user has at least one character, a few have many
+    counts = 1 + rng.poisson(per_user - 1, users) if per_user > 1 else np.ones(users, dtype=np.int64)
+    owners = np.repeat(np.arange(1, users + 1), counts)
+    weapon_ids = np.zeros(owners.size, dtype=np.int64)
+    if weapon_atks:
+        equipped = rng.random(owners.size) < EQUIPPED_SHARE
+        weapon_ids[equipped] = rng.choice(np.arange(1, len(weapon_atks) + 1), equipped.sum(),
+                                          p=popularity(rng, len(weapon_atks), 1.1))
+
+    characters = []
+    for cid, (uid, wid) in enumerate(zip(owners.tolist(), weapon_ids.tolist()), 1):
+        name = f"{NAMES[(cid * 7) % len(NAMES)]} {cid}"
+        inserter.add(Character.__table__, dict(NO_STATS, id=cid, name=name, mhp=combat.STARTING_MHP,
+                                               atk=combat.STARTING_ATK, weapon_id=wid or None,
+                                               user_id=uid, active_battle_id=None))
+        characters.append({"name": name, "user_id": uid, "mhp": combat.STARTING_MHP,
+                           "atk": combat.STARTING_ATK, "weapon_atk": weapon_atks.get(wid, 0), "active": None})
+    return characters
+
+def seed_friendships(inserter, rng, users, mean_friends, max_friends):
+    # Heavy-tailed degrees with popular users befriended more often, kept
+    # symmetric like an accepted friend request
+    degrees = np.minimum(rng.zipf(2.1, users), max_friends)
+    degrees = np.minimum(np.round(degrees * mean_friends / degrees.mean()).astype(np.int64), max_friends)
+    sources = np.repeat(np.arange(1, users + 1), degrees)
+    targets = rng.choice(np.arange(1, users + 1), sources.size, p=popularity(rng, users, 0.8))
+    keep = sources != targets
+    pairs = np.unique(np.sort(np.stack([sources[keep], targets[keep]], axis=1), axis=1), axis=0)
+    for first, second in pairs.tolist():
+        inserter.add(friends_table, {"friender_id": first, "friendee_id": second})
+        inserter.add(friends_table, {"friender_id": second, "friendee_id": first})
+    return len(pairs)
+
+def choose_battlers(rng, characters, battles):
+    activity = popularity(rng, len(characters), 0.8)
+    challengers = rng.choice(len(characters), battles, p=activity)
+    opponents = rng.choice(len(characters), battles, p=activity)
+    against_ai = rng.random(battles) < AI_SHARE
+    for challenger, opponent, ai in zip(challengers.tolist(), opponents.tolist(), against_ai.tolist()):
+        if ai or characters[challenger]["user_id"] == characters[opponent]["user_id"]:
+            yield challenger, None
+        else:
+            yield challenger, opponent
+
+def play_battle(inserter, play, bid, lid, timestamp, characters, challenger, opponent, unfinished):
+    # Plays a battle by the server's rules and writes the rows resolve_round would have
+    c = characters[challenger]
+    o = c if opponent is None else characters[opponent]
+    c_atk, o_atk = c["atk"] + c["weapon_atk"], o["atk"] + o["weapon_atk"]
+    c_mhp, o_mhp = c_hp, o_hp = c["mhp"], o["mhp"]
+    rounds = 0
+    battle_seed = play.getrandbits(31)
+    actions = []
+    logs = [{"challenger_hp": c_hp, "opponent_hp": o_hp, "kind": LOG_START, "round": rounds}]
+
+    stop_after = play.randint(1, 3) if unfinished else None
+    while c_hp and o_hp and rounds != stop_after:
+        c_act = play.choices(combat.ACTIONS, PLAYER_ACTION_WEIGHTS)[0]
+        o_act = (dao.ai_action(dao.round_rng(battle_seed, rounds)) if opponent is None
+                 else play.choices(combat.ACTIONS, PLAYER_ACTION_WEIGHTS)[0])
+        actions.append(f"{combat.ACTION_CODES[c_act]}{combat.ACTION_CODES[o_act]}")
+        (c_hp, o_hp), c_dealt, o_dealt = combat.resolve((c_hp, c_act, c_atk), (o_hp, o_act, o_atk))
+        rounds += 1
+        logs.append({"challenger_hp": c_hp, "opponent_hp": o_hp, "kind": LOG_ROUND, "round": rounds,
+                     "challenger_action": combat.ACTION_CODES[c_act], "opponent_action": combat.ACTION_CODES[o_act],
+                     "challenger_dealt": c_dealt, "opponent_dealt": o_dealt})
+
+    done = not (c_hp and o_hp)
+    winner = None
+    if done:
+        if not c_hp and not o_hp:
+            kind = LOG_DRAW
+        else:
+            kind = LOG_WIN
+            winner = c if o_hp == 0 else None if opponent is None else o
+        logs.append({"challenger_hp": c_hp, "opponent_hp": o_hp, "kind": kind, "round": rounds})
+    if winner is not None:
+        winner["mhp"] += combat.MHP_INCREMENT
+        winner["atk"] += combat.ATK_INCREMENT
+    if not done:
+        c["active"] = bid
+        if opponent is not None:
+            o["active"] = bid
+
+    inserter.add(Battle.__table__, {
+        "id": bid, "challenger_id": challenger + 1, "opponent_id": None if opponent is None else opponent + 1,
+        "done": done, "challenger_hp": c_hp, "opponent_hp": o_hp, "challenger_atk": c_atk,
+        "opponent_atk": o_atk, "round": rounds, "challenger_name": c["name"],
+        "opponent_name": None if opponent is None else o["name"], "version": 1 + len(logs),
+        "seed": battle_seed, "actions": "".join(actions), "challenger_mhp": c_mhp, "opponent_mhp": o_mhp,
+        "archive": None})
+    inserter.add(Action.__table__, {"id": bid, "battle_id": bid, "challenger_action": None, "opponent_action": None})
+    for i, log in enumerate(logs):
+        inserter.add(Log.__table__, dict(LOG_DEFAULTS, id=lid + i, timestamp=timestamp, battle_id=bid, **log))
+        timestamp += play.randint(1, 30) * SECOND
+    return len(logs)
+
+def seed_battles(inserter, rng, play, characters, battles):
+    bid, lid = 0, 1
+    timestamp = BASE_TIMESTAMP
+    unfinished_from = battles - int(battles * UNFINISHED_SHARE)
+    for i, (challenger, opponent) in enumerate(choose_battlers(rng, characters, battles)):
+        # A character fights one battle at a time, so ones left mid-battle sit the rest out
+        if characters[challenger]["active"] or (opponent is not None and characters[opponent]["active"]):
+            continue
+        bid += 1
+        timestamp += play.randint(1, 600) * SECOND
+        lid += play_battle(inserter, play, bid, lid, timestamp, characters, challenger, opponent,
+                           unfinished=i >= unfinished_from)
+
+def save_character_stats(conn, characters, batch_size):
+    # Characters were inserted at their starting stats before any battle could
+    # point at them, so what they ended up with is written back afterwards
+    table = Character.__table__
+    statement = table.update().where(table.c.id == bindparam("cid")).values(
+        mhp=bindparam("new_mhp"), atk=bindparam("new_atk"), active_battle_id=bindparam("bid"))
+    rows = [{"cid": cid, "new_mhp": c["mhp"], "new_atk": c["atk"], "bid": c["active"]}
+            for cid, c in enumerate(characters, 1)
+            if c["mhp"] != combat.STARTING_MHP or c["active"] is not None]
+    for start in range(0, len(rows), batch_size):
+        conn.execute(statement, rows[start:start + batch_size])
+
+def seed(conn, users, weapons, characters_per_user, friends, max_friends, battles, seed=0, batch_size=10000):
+    # Everything random comes from the seed, so the same arguments always
+    # write the same rows
+    rng = np.random.default_rng(seed)
+    play = random.Random(seed)
+    inserter = Inserter(conn, batch_size)
+
+    seed_users(inserter, rng, users)
+    weapon_atks = seed_weapons(inserter, rng, weapons)
+    inserter.flush_all([User.__table__, Weapon.__table__, Catalog.__table__])
+    characters = seed_characters(inserter, rng, users, characters_per_user, weapon_atks)
+    seed_friendships(inserter, rng, users, friends, max_friends)
+    inserter.flush_all([Character.__table__, friends_table])
+    if characters:
+        seed_battles(inserter, rng, play, characters, battles)
+    inserter.flush_all([Battle.__table__, Action.__table__, Log.__table__])
+    save_character_stats(conn, characters, batch_size)
+    dao.rebuild_analytics(conn)
+    reset_sequences(conn, SEEDED_TABLES)
+    return inserter.counts
+
+#########
+#  CLI  #
+#########
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fills a database with a large, deterministic synthetic "
+        "dataset for scale testing. Writes through SQLAlchemy Core, not the API. Run loadtest.py "
+        "against it with TEST_DATABASE_URL set to the same database.")
+    parser.add_argument("--url", default=config.database_uri(), help="database to fill, DATABASE_URL by default")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--weapons", type=int, default=500)
+    parser.add_argument("--characters-per-user", type=float, default=2, help="mean, every user gets at least one")
+    parser.add_argument("--friends", type=float, default=8, help="mean friends per user")
+    parser.add_argument("--max-friends", type=int, default=1000)
+    parser.add_argument("--battles", type=int, default=300000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=10000, help="rows per executemany")
+    parser.add_argument("--reset", action="store_true", help="drop and recreate every table first")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    engine = create_engine(args.url)
+    set_sqlite_pragmas(engine, config.Config.SQLITE_PRAGMAS)
+    if args.reset:
+        db.Model.metadata.drop_all(engine)
+    db.Model.metadata.create_all(engine)
+
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        # A sessionless Query builds the same SELECT on every SQLAlchemy version
+        if conn.execute(Query([func.count(User.__table__.c.id)]).statement).scalar():
+            raise SystemExit("The database already has users, pass --reset to replace them")
+        counts = seed(conn, args.users, args.weapons, args.characters_per_user, args.friends,
+                      args.max_friends, args.battles, args.seed, args.batch_size)
+    elapsed = time.perf_counter() - start
+
+    for table, count in counts.items():
+        print(f"{table:<12} {count:>12} rows")
+    total = sum(counts.values())
+    print(f"{total} rows in {elapsed:.1f} s, {total / elapsed:.0f} rows/s")
+
+if __name__ == "__main__":
+    main()
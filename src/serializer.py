@@ -0,0 +1,22 @@
+import json
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+# Every backend turns data into UTF-8 JSON bytes and reads back bytes or str
+BACKENDS = {
+  "json": (lambda data: json.dumps(data, ensure_ascii=False).encode("utf-8"), json.loads),
+}
+if orjson is not None:
+  BACKENDS["orjson"] = (orjson.dumps, orjson.loads)
+
+MIMETYPE = "application/json"
+
+def use(backend):
+  global BACKEND, dumps, loads
+  BACKEND = backend
+  dumps, loads = BACKENDS[backend]
+
+use("orjson" if orjson is not None else "json")
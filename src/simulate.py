@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import combat
+
+# Outcome codes, from the challenger's side like generate_win_log
+UNFINISHED, WIN, LOSS, DRAW = 0, 1, 2, 3
+POLICIES = ["random"] + combat.ACTIONS
+
+################
+#  SIMULATION  #
+################
+
+def stats_at(level, weapon_atk, mhp_increment, atk_increment):
+    # A character after `level` wins, carrying a weapon
+    return (combat.STARTING_MHP + level * mhp_increment,
+            combat.STARTING_ATK + level * atk_increment + weapon_atk)
+
+def choose_actions(policy, rng, size):
+    if policy == "random":
+        return rng.integers(0, 3, size)
+    return np.full(size, combat.ACTION_CODES[policy])
+
+def simulate_chunk(task):
+    (c_mhp, c_atk), (o_mhp, o_atk), policy, opponent_policy, battles, max_rounds, seed = task
+    rng = np.random.default_rng(seed)
+    c_hp = np.full(battles, c_mhp, dtype=np.float64)
+    o_hp = np.full(battles, o_mhp, dtype=np.float64)
+    outcomes = np.full(battles, UNFINISHED, dtype=np.int8)
+    rounds = np.full(battles, max_rounds, dtype=np.int64)
+
+    # Only battles still going are resolved each round
+    active = np.arange(battles)
+    for round_number in range(1, max_rounds + 1):
+        if active.size == 0:
+            break
+        c_act = choose_actions(policy, rng, active.size)
+        o_act = choose_actions(opponent_policy, rng, active.size)
+        new_c_hp, new_o_hp, _, _ = combat.resolve_batch(c_hp[active], c_act, c_atk,
+                                                       o_hp[active], o_act, o_atk)
+        c_hp[active], o_hp[active] = new_c_hp, new_o_hp
+
+        c_down, o_down = new_c_hp == 0, new_o_hp == 0
+        outcomes[active[c_down & o_down]] = DRAW
+        outcomes[active[c_down & ~o_down]] = LOSS
+        outcomes[active[o_down & ~c_down]] = WIN
+        finished = c_down | o_down
+        rounds[active[finished]] = round_number
+        active = active[~finished]
+
+    return (np.bincount(outcomes, minlength=4),
+            np.bincount(rounds[outcomes != UNFINISHED], minlength=max_rounds + 1))
+
+def simulate(challenger, opponent, policy, opponent_policy, battles, max_rounds, seed, pool, chunk_size):
+    chunks = [min(chunk_size, battles - start) for start in range(0, battles, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    tasks = [(challenger, opponent, policy, opponent_policy, size, max_rounds, chunk_seed)
+             for size, chunk_seed in zip(chunks, seeds)]
+
+    outcomes = np.zeros(4, dtype=np.int64)
+    histogram = np.zeros(max_rounds + 1, dtype=np.int64)
+    for chunk_outcomes, chunk_histogram in pool.map(simulate_chunk, tasks):
+        outcomes += chunk_outcomes
+        histogram += chunk_histogram
+    return outcomes, histogram
+
+###############
+#  REPORTING  #
+###############
+
+def percentile(histogram, fraction):
+    total = histogram.sum()
+    if total == 0:
+        return None
+    return int(np.searchsorted(np.cumsum(histogram), fraction * total))
+
+def summarize(config, outcomes, histogram):
+    battles = int(outcomes.sum())
+    finished = int(histogram.sum())
+    rounds = np.arange(histogram.size)
+    return dict(config,
+        battles=battles,
+        win_rate=outcomes[WIN] / battles,
+        loss_rate=outcomes[LOSS] / battles,
+        draw_rate=outcomes[DRAW] / battles,
+        unfinished_rate=outcomes[UNFINISHED] / battles,
+        mean_rounds=float((rounds * histogram).sum() / finished) if finished else None,
+        p50_rounds=percentile(histogram, 0.5),
+        p90_rounds=percentile(histogram, 0.9),
+        p99_rounds=percentile(histogram, 0.99),
+        max_rounds=int(rounds[histogram > 0].max()) if finished else None,
+        # Sparse so a long cap doesn't print thousands of zero buckets
+        round_histogram={int(r): int(histogram[r]) for r in np.flatnonzero(histogram)}
+    )
+
+def print_table(results):
+    header = (f"{'level':>5} {'weapon':>6} {'mhp':>5} {'atk':>5} {'win':>7} {'loss':>7} {'draw':>7} "
+              f"{'unfin':>7} {'mean':>7} {'p50':>5} {'p90':>5} {'p99':>5}")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['level']:>5} {r['weapon_atk']:>6} {r['mhp']:>5} {r['atk']:>5} "
+              f"{r['win_rate']:>7.2%} {r['loss_rate']:>7.2%} {r['draw_rate']:>7.2%} "
+              f"{r['unfinished_rate']:>7.2%} {r['mean_rounds'] or 0:>7.2f} "
+              f"{r['p50_rounds'] or 0:>5} {r['p90_rounds'] or 0:>5} {r['p99_rounds'] or 0:>5}")
+
+#########
+#  CLI  #
+#########
+
+int_list = lambda value: [int(x) for x in value.split(",")]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Monte Carlo balance simulator for AI battles. "
+        "Plays the server's rules in-process; no server or database is needed.")
+    parser.add_argument("--battles", type=int, default=100000, help="battles per configuration")
+    parser.add_argument("--levels", type=int_list, default=[0], help="comma separated win counts to simulate at")
+    parser.add_argument("--weapons", type=int_list, default=[0], help="comma separated weapon atk values")
+    parser.add_argument("--policy", choices=POLICIES, default="random", help="challenger strategy")
+    parser.add_argument("--vs", metavar="LEVEL:WEAPON", help="fight a fixed opponent instead of the mirrored AI")
+    parser.add_argument("--opponent-policy", choices=POLICIES, default="random")
+    parser.add_argument("--mhp-increment", type=int, default=combat.MHP_INCREMENT)
+    parser.add_argument("--atk-increment", type=int, default=combat.ATK_INCREMENT)
+    parser.add_argument("--max-rounds", type=int, default=1000, help="battles still going after this are unfinished")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=100000, help="battles per worker task")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    increments = (args.mhp_increment, args.atk_increment)
+    opponent = None
+    if args.vs:
+        vs_level, vs_weapon = (int(x) for x in args.vs.split(":"))
+        opponent = stats_at(vs_level, vs_weapon, *increments)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for i, (level, weapon_atk) in enumerate((l, w) for l in args.levels for w in args.weapons):
+            challenger = stats_at(level, weapon_atk, *increments)
+            # The AI mirrors the challenger, exactly like create_battle
+            outcomes, histogram = simulate(challenger, opponent or challenger, args.policy,
+                                           args.opponent_policy, args.battles, args.max_rounds,
+                                           [args.seed, i], pool, args.chunk_size)
+            config = {"level": level, "weapon_atk": weapon_atk, "mhp": challenger[0], "atk": challenger[1]}
+            results.append(summarize(config, outcomes, histogram))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,4 @@
-gunicorn --bind 0.0.0.0:5000 --workers=4 app:app
\ No newline at end of file
+# Battle watchers each hold a thread while connected, so Config.MAX_EVENT_STREAMS
+# (4 by default) of every worker's threads may stream at once, leaving the rest
+# for everything else. Raise them together.
+gunicorn --bind 0.0.0.0:5000 --workers=4 --threads=8 app:app
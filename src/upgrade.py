@@ -0,0 +1,218 @@
+import argparse
+import random
+import re
+import time
+from sqlalchemy import MetaData, bindparam, create_engine
+import config
+import dao
+from db import (Action, Battle, Catalog, Character, Log, Request, User, Weapon, db, friends_table,
+                reset_sequences, set_sqlite_pragmas, LOG_CUSTOM)
+
+# In foreign key order. Characters go in before the battles they point at and
+# get their active battles afterwards.
+COPIED_TABLES = [User.__table__, Weapon.__table__, Catalog.__table__, Character.__table__, friends_table,
+                 Request.__table__, Battle.__table__, Action.__table__, Log.__table__]
+# Added since the first schema, so only copied when the old database has them
+ADDED_TABLES = [Catalog.__table__]
+
+# Recounted by dao.rebuild_analytics once everything is in
+NO_STATS = {"wins": 0, "losses": 0, "draws": 0, "rounds_fought": 0}
+
+# How a round read before logs were stored structured
+ROUND_TEXT = re.compile(r"Challenger .* used \w+ and dealt .* damage! Opponent .* used \w+ and dealt .* damage!")
+
+#############
+#  READING  #
+#############
+
+def read_rows(conn, table, batch_size):
+    # In id order, which for logs is the order they were written in
+    result = conn.execute(table.select().order_by(*table.primary_key.columns))
+    keys = list(result.keys())
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            return
+        yield [dict(zip(keys, row)) for row in rows]
+
+class History:
+    # What the old rows say about the columns they're missing, read up front
+
+    def __init__(self, conn, old):
+        self.characters = {}
+        for rows in read_rows(conn, old["character"], 10000):
+            self.characters.update((row["id"], row) for row in rows)
+        self.weapon_atks = {}
+        for rows in read_rows(conn, old["weapon"], 10000):
+            self.weapon_atks.update((row["id"], row["atk"]) for row in rows)
+
+        # Per battle, the HP its first and newest logs hold and how many rounds it logged
+        self.battles = {}
+        # Rounds logged so far by each battle, counted again as its logs are copied
+        self.log_rounds = {}
+        logs = old["log"]
+        result = conn.execute(logs.select().order_by(logs.c.battle_id, logs.c.id))
+        keys = list(result.keys())
+        for row in result:
+            log = dict(zip(keys, row))
+            hps = (log["challenger_hp"], log["opponent_hp"])
+            battle = self.battles.setdefault(log["battle_id"], {"first": hps, "rounds": 0})
+            battle["last"] = hps
+            if is_round(log):
+                battle["rounds"] += 1
+
+    def battler(self, battle, side):
+        # The AI mirrors the challenger, as start_battle has it
+        cid = battle.get(f"{side}_id") or battle["challenger_id"]
+        return self.characters.get(cid, {"mhp": 0, "atk": 0, "weapon_id": None, "name": ""})
+
+    def atk(self, character):
+        return character["atk"] + self.weapon_atks.get(character["weapon_id"], 0)
+
+def is_round(log):
+    return bool(ROUND_TEXT.fullmatch(log.get("action") or ""))
+
+#############
+#  FILLING  #
+#############
+
+# Each returns every column its table has gained since the oldest schema,
+# worked out from the old row. Columns the old row already has win.
+
+def fill_user(row, history):
+    return {"version": 1}
+
+def fill_weapon(row, history):
+    return dict(NO_STATS)
+
+def fill_character(row, history):
+    return dict(NO_STATS)
+
+def fill_battle(row, history):
+    challenger, opponent = history.battler(row, "challenger"), history.battler(row, "opponent")
+    logs = history.battles.get(row["id"], {})
+    # The newest log always held the battle's HP, a battle without logs never started
+    c_mhp, o_mhp = logs.get("first", (challenger["mhp"], opponent["mhp"]))
+    c_hp, o_hp = logs.get("last", (c_mhp, o_mhp))
+    return {
+        "challenger_hp": c_hp,
+        "opponent_hp": o_hp,
+        # Attack used to be worked out every round from the battlers as they are
+        "challenger_atk": history.atk(challenger),
+        "opponent_atk": history.atk(opponent),
+        "round": logs.get("rounds", 0),
+        "version": 1,
+        # Names as they are now, the old logs keep the ones they were written with
+        "challenger_name": challenger["name"],
+        "opponent_name": None if row["opponent_id"] is None else opponent["name"],
+        # Old rounds weren't recorded as actions, so these battles can't be
+        # replayed and archive_battles leaves them be. Ones still going draw
+        # the AI's moves from a seed of their own from here on.
+        "seed": random.getrandbits(31),
+        "actions": "",
+        "challenger_mhp": c_mhp,
+        "opponent_mhp": o_mhp,
+        "archive": None,
+    }
+
+def fill_log(row, history):
+    # Old logs only have their text, so they become custom logs, which render
+    # it exactly as it was written
+    rounds = history.log_rounds.get(row["battle_id"], 0) + is_round(row)
+    history.log_rounds[row["battle_id"]] = rounds
+    return {"kind": LOG_CUSTOM, "round": rounds}
+
+FILLS = {"user": fill_user, "weapon": fill_weapon, "character": fill_character, "battle": fill_battle,
+         "log": fill_log}
+
+###############
+#  UPGRADING  #
+###############
+
+def copy_table(source, target, old_table, table, history, batch_size):
+    fill = FILLS.get(table.name, lambda row, history: {})
+    columns = [column.name for column in table.columns]
+    copied = 0
+    for rows in read_rows(source, old_table, batch_size):
+        new_rows = []
+        for row in rows:
+            values = dict(fill(row, history), **{name: value for name, value in row.items() if name in columns})
+            if table is Character.__table__:
+                values["active_battle_id"] = None # see save_active_battles
+            new_rows.append({name: values.get(name) for name in columns})
+        target.execute(table.insert(), new_rows)
+        copied += len(new_rows)
+    return copied
+
+def save_active_battles(target, batch_size):
+    # Battles still going are the only ones characters point at, the newest
+    # one wins if the old data has a character in two
+    battle, character = Battle.__table__, Character.__table__
+    active = {}
+    unfinished = battle.select().where(battle.c.done == False).order_by(battle.c.id)
+    for row in target.execute(unfinished):
+        row = dict(zip(battle.columns.keys(), row))
+        for cid in (row["challenger_id"], row["opponent_id"]):
+            if cid is not None:
+                active[cid] = row["id"]
+
+    rows = [{"cid": cid, "bid": bid} for cid, bid in active.items()]
+    statement = character.update().where(character.c.id == bindparam("cid")).values(active_battle_id=bindparam("bid"))
+    for start in range(0, len(rows), batch_size):
+        target.execute(statement, rows[start:start + batch_size])
+
+def upgrade(source, target, batch_size=10000):
+    # Copies a database written by any earlier version into one with the
+    # current schema, which the caller has created and left empty. The source
+    # is only read, so it stays as it was if anything goes wrong.
+    old = MetaData()
+    old.reflect(bind=source)
+    missing = [table.name for table in COPIED_TABLES if table.name not in old.tables and table not in ADDED_TABLES]
+    if missing:
+        raise ValueError(f"Not a database of this app, it has no {', '.join(missing)} table")
+
+    history = History(source, old.tables)
+    counts = {}
+    for table in COPIED_TABLES:
+        if table.name in old.tables:
+            counts[table.name] = copy_table(source, target, old.tables[table.name], table, history, batch_size)
+    save_active_battles(target, batch_size)
+    # Old rounds were logged as text, which the matchup counts can't read, so
+    # those only cover battles fought after the upgrade
+    dao.rebuild_analytics(target)
+    reset_sequences(target, COPIED_TABLES)
+    return counts
+
+#########
+#  CLI  #
+#########
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Copies a database from an earlier version of the app into "
+        "a new one with the current schema, filling in every column added since from the old rows. "
+        "The old database is left untouched.")
+    parser.add_argument("source", help="database to upgrade, e.g. sqlite:////usr/app/data/ai.db")
+    parser.add_argument("--url", default=config.database_uri(),
+                        help="empty database to write to, DATABASE_URL by default")
+    parser.add_argument("--batch-size", type=int, default=10000, help="rows per executemany")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    source_engine, target_engine = create_engine(args.source), create_engine(args.url)
+    set_sqlite_pragmas(target_engine, config.Config.SQLITE_PRAGMAS)
+    db.Model.metadata.create_all(target_engine)
+
+    start = time.perf_counter()
+    with source_engine.connect() as source, target_engine.begin() as target:
+        if target.execute(User.__table__.select().limit(1)).first() is not None:
+            raise SystemExit("The target database already has users, upgrade into an empty one")
+        counts = upgrade(source, target, args.batch_size)
+    elapsed = time.perf_counter() - start
+
+    for table, count in counts.items():
+        print(f"{table:<12} {count:>12} rows")
+    print(f"{sum(counts.values())} rows in {elapsed:.1f} s")
+
+if __name__ == "__main__":
+    main()